@@ -0,0 +1,219 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from lxml import etree
+
+import main
+
+STIX_NS = "http://stix.mitre.org/stix-1"
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+RESULTS = "./benchmark.json"
+MIN_REGRESSION = 0.005#seconds, smaller slowdowns are timer noise
+
+"""Parses a comma separated list of numbers for the scaling matrix options"""
+def number_list(value, convert=int):
+    return [convert(item) for item in value.split(',') if item]
+
+"""Generates synthetic STIX documents from the loaded schemas. Starting at STIX_Package, each
+element is given up to fanout children picked from those its type (and the types it extends)
+declares, down to depth levels. Where an element's type has types derived from it, such as
+cybox:Properties, one of them is chosen as its xsi:type with probability xsi_mix. The documents
+only use declared elements and types, so they reach the same lookups real input does, but they do not
+validate against the XSDs: children are not in xsd:sequence order, the root is revisited so maxOccurs is
+exceeded, minOccurs children and required attributes are left out, choices are not exclusive and no
+element has text. They are workloads for timing main.py, which does not validate its input, and not
+conformance fixtures"""
+class StixGenerator:
+    def __init__(self, schemas, seed=0):
+        self.schemas = schemas
+        self.random = random.Random(seed)
+        self.prefixes = {XSI_NS : 'xsi'}
+        self.derived_types = {}#(namespace, complexType name) -> [(namespace, name) of the types extending it]
+        self.type_children = {}#(namespace, complexType name) -> get_type_children result
+        for namespace in sorted(schemas):
+            schema = schemas[namespace]
+            if namespace != XML_NS:#always bound to xml, which may not be redeclared
+                self.prefixes[namespace] = 'ns' + str(len(self.prefixes))
+            for name, complex_type in sorted(schema.index.complex_types.iteritems()):
+                for base in complex_type['extensions']:
+                    self.derived_types.setdefault(schema.resolve_qname(base), []).append((namespace, name))
+
+    """Returns the (namespace, name) of the type declared for an element, or None if it has none"""
+    def get_element_type(self, namespace, name):
+        if namespace not in self.schemas:
+            return None
+        schema = self.schemas[namespace]
+        types = schema.index.element_types.get(name)
+        if not types:
+            return None
+        return schema.resolve_qname(types[-1])
+
+    """Returns the (namespace, name) of every element a type and the types it extends may contain"""
+    def get_type_children(self, el_type):
+        if el_type in self.type_children:
+            return self.type_children[el_type]
+        key = el_type
+        children = []
+        seen = set()
+        while el_type is not None and el_type not in seen and el_type[0] in self.schemas:
+            seen.add(el_type)
+            schema = self.schemas[el_type[0]]
+            complex_type = schema.index.get_complex_type(el_type[1])
+            children.extend([(schema.namespace, child) for child in sorted(complex_type['elements'])])
+            #refs into schemas that are not bundled (e.g. CVRF) are left out
+            children.extend([ref for ref in [schema.resolve_qname(ref) for ref in sorted(complex_type['element_refs'])] if ref[0] in self.schemas])
+            el_type = schema.resolve_qname(complex_type['extensions'][0]) if complex_type['extensions'] else None
+        self.type_children[key] = children
+        return children
+
+    """Generates a document of about the given number of elements, returns it and its element count"""
+    def generate(self, nodes, fanout, depth, xsi_mix):
+        root = etree.Element('{' + STIX_NS + '}STIX_Package', nsmap=dict([(prefix, ns) for ns, prefix in self.prefixes.iteritems()]))
+        root_type = self.get_element_type(STIX_NS, 'STIX_Package')
+        count = 1
+        #Each frame holds: parent element, its type, its depth; the root is revisited until the budget is spent
+        while count < nodes:
+            added = count
+            stack = [(root, root_type, 1)]
+            while stack and count < nodes:
+                parent, el_type, level = stack.pop()
+                if level >= depth:
+                    continue
+                children = self.get_type_children(el_type)
+                for namespace, name in self.random.sample(children, min(fanout, len(children))):
+                    if count >= nodes:
+                        break
+                    child = etree.SubElement(parent, '{' + namespace + '}' + name)
+                    count += 1
+                    stack.append((child, self.choose_type(child, namespace, name, xsi_mix), level + 1))
+            if count == added:
+                break#nothing beneath the root can be expanded any further
+        return etree.ElementTree(root), count
+
+    """Returns the type to expand an element with, setting xsi:type to a derived one now and again"""
+    def choose_type(self, element, namespace, name, xsi_mix):
+        el_type = self.get_element_type(namespace, name)
+        derived = self.derived_types.get(el_type)
+        if derived and self.random.random() < xsi_mix:
+            el_type = self.random.choice(derived)
+            element.set('{' + XSI_NS + '}type', self.prefixes[el_type[0]] + ':' + el_type[1])
+        return el_type
+
+"""Runs main.py over a file with --profile, returning its profile"""
+def profile_run(path, stream=False, jobs=1):
+    handle, profile_path = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    try:
+        command = [sys.executable, 'main.py', '--profile', profile_path, '-f', 'jsonl', '-j', str(jobs), path]
+        if stream:
+            command.insert(2, '--stream')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(command, stdout=devnull)
+        with open(profile_path, 'r') as pfile:
+            profile = json.load(pfile)
+    finally:
+        os.remove(profile_path)
+    if not profile['counters'].get('files'):
+        raise RuntimeError("main.py could not analyze " + path)
+    return profile
+
+"""Keeps the fastest wall and CPU time of each phase over repeated profiles, and the largest peak RSS"""
+def best_of(profiles):
+    best = {'wall' : min([profile['wall'] for profile in profiles]),
+            'peak_rss_kb' : max([profile['peak_rss_kb'] for profile in profiles]),
+            'phases' : {}}
+    for profile in profiles:
+        for phase, timing in profile['phases'].iteritems():
+            if phase not in best['phases'] or timing['wall'] < best['phases'][phase]['wall']:
+                best['phases'][phase] = timing
+    return best
+
+"""Returns a description of each config that ran slower than in the baseline by more than tolerance"""
+def find_regressions(results, baseline, tolerance, phases):
+    regressions = []
+    previous = dict([(config['name'], config) for config in baseline['configs']])
+    for config in results['configs']:
+        if config['name'] not in previous:
+            continue
+        old = previous[config['name']]
+        measures = [('wall', old['wall'], config['wall'])]
+        for phase in phases:
+            if phase in old['phases'] and phase in config['phases']:
+                measures.append((phase, old['phases'][phase]['wall'], config['phases'][phase]['wall']))
+        for measure, before, after in measures:
+            if before > 0 and after > before * (1 + tolerance) and after - before > MIN_REGRESSION:
+                regressions.append("%s %s: %.4fs -> %.4fs (+%.0f%%)" % (config['name'], measure, before, after, (after / before - 1) * 100))
+    return regressions
+
+"""Generates a document per point of the scaling matrix, profiles main.py on each and records the results"""
+def run(args):
+    xsd_files = [open('xsds/' + filename, 'r') for filename in os.listdir('xsds')]
+    context = main.load_context(xsd_files, main.SCHEMA_CACHE)
+    for sfile in xsd_files:
+        sfile.close()
+    generator = StixGenerator(context.schemas, args.seed)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='stixbench')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    results = {
+               'python' : platform.python_version(),
+               'platform' : platform.platform(),
+               'time' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'stream' : args.stream,
+               'jobs' : args.jobs,
+               'configs' : []
+               }
+    print "%-32s %8s %10s %9s %9s %9s %9s" % ('config', 'elements', 'bytes', 'wall', 'parse', 'walk', 'stats')
+    try:
+        for nodes, fanout, depth, xsi_mix in itertools.product(args.nodes, args.fanout, args.depth, args.xsi_mix):
+            name = "n%d-f%d-d%d-x%g" % (nodes, fanout, depth, xsi_mix)
+            path = os.path.join(workdir, name + '.xml')
+            tree, count = generator.generate(nodes, fanout, depth, xsi_mix)
+            tree.write(path, xml_declaration=True, encoding='UTF-8')
+            config = best_of([profile_run(path, args.stream, args.jobs) for i in range(args.repeat)])
+            config.update({'name' : name, 'nodes' : nodes, 'fanout' : fanout, 'depth' : depth, 'xsi_mix' : xsi_mix,
+                           'elements' : count, 'bytes' : os.path.getsize(path)})
+            results['configs'].append(config)
+            phases = config['phases']
+            print "%-32s %8d %10d %9.4f %9.4f %9.4f %9.4f" % (name, count, config['bytes'], config['wall'],
+                  phases.get('parse', {}).get('wall', 0), phases['walk']['wall'], phases['file_stats']['wall'])
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    with open(args.output, 'w') as rfile:
+        json.dump(results, rfile, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as bfile:
+            baseline = json.load(bfile)
+        regressions = find_regressions(results, baseline, args.tolerance, ['walk', 'closure', 'file_stats'])
+        for regression in regressions:
+            print "REGRESSION " + regression
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time Stix Analytix over synthetic STIX documents generated from the bundled XSDs')
+    parser.add_argument('-n', '--nodes', type=number_list, default=[1000, 10000, 100000], help='Comma separated element counts to generate (default: 1000,10000,100000)')
+    parser.add_argument('--fanout', type=number_list, default=[4], help='Comma separated most children per element (default: 4)')
+    parser.add_argument('--depth', type=number_list, default=[8, 32], help='Comma separated deepest nesting levels (default: 8,32)')
+    parser.add_argument('--xsi-mix', type=lambda value: number_list(value, float), default=[0.0, 0.5], help='Comma separated chances of giving an element a derived xsi:type (default: 0,0.5)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed, so the same matrix generates the same documents (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per document, the fastest of which is recorded (default: 3)')
+    parser.add_argument('-s', '--stream', action='store_true', help='Benchmark --stream analysis')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes to pass to main.py (default: 1)')
+    parser.add_argument('-w', '--workdir', help='Directory to keep the generated documents in (default: a temporary one)')
+    parser.add_argument('-o', '--output', default=RESULTS, help='File to record the results in (default: ' + RESULTS + ')')
+    parser.add_argument('-b', '--baseline', help='Earlier results to compare against, exiting with 1 if any config regressed')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='Slowdown over the baseline tolerated before reporting a regression (default: 0.2)')
+    sys.exit(run(parser.parse_args()))
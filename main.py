@@ -1,40 +1,93 @@
 import argparse
+import bz2
+import contextlib
+import cPickle
+import csv
+import errno
+import glob
+import gzip
+import hashlib
 import logging
 from lxml import etree, objectify
 import json
+import multiprocessing
 import os
 import random
-import string
-from numpy import average
+import resource
+import array
+import numpy
+import Queue
+import signal
+import socket
+import stat
+import SocketServer
+import StringIO
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+try:
+    from backports import lzma
+except ImportError:
+    lzma = None#.xz archives can only be read with backports.lzma installed
 
-g_child_lookup = {}
-g_schemas = {}
+g_context = None#SchemaContext the command line runs against, set up by StixAnalytix.load_schemas before any worker is forked
+g_profile = None#Profile collecting timings and counters while --profile is given
+
+XSD_NS = "{http://www.w3.org/2001/XMLSchema}"
+XSI_TYPE = "{http://www.w3.org/2001/XMLSchema-instance}type"
+SCHEMA_CACHE = "./StixAnalytix.cache"
+SCHEMA_CACHE_VERSION = 2
+RESULT_CACHE_VERSION = 1#bump whenever the per-file results change
+RESULT_CACHE_ENTRIES = 10000
+RESULT_CACHE_BYTES = 512 * 1024 * 1024
+SERVE_QUEUE = 16
+SERVE_TIMEOUT = 30#seconds a --serve client may take to send its document
+SERVE_MAX_BYTES = 64 * 1024 * 1024#largest document --serve accepts
+SERVE_EVICT_EVERY = 100#submissions between trims of the --serve result cache
+SERVE_DRAINERS = 2#threads answering turned away --serve connections BUSY and reading what they still send
+STREAM_CHUNK_ROWS = 65536#element rows --stream holds before folding them into the per type totals
+SAMPLE_SEED = 0#sampled estimates are repeatable from run to run
+SAMPLE_Z = 1.96#confidence intervals of sampled estimates are 95%
+SUBMITTED_NAME = "<submitted>"
+WARM_NAME = "<schemas>"#the input named by the Analytic SchemaContext.warm fills the lookups in with
+ARCHIVE_SEPARATOR = "!"#between the archive's path and a member's name, e.g. feed.tar.gz!feed/package.xml
+COMPRESSED_EXTENSIONS = {
+                         '.gz' : gzip.GzipFile,
+                         '.tgz' : gzip.GzipFile,
+                         '.bz2' : bz2.BZ2File,
+                         '.tbz2' : bz2.BZ2File,
+                         '.xz' : lzma.LZMAFile if lzma else None,
+                         '.txz' : lzma.LZMAFile if lzma else None
+                         }
+ARCHIVE_EXTENSIONS = ('.zip', '.tar') + tuple(COMPRESSED_EXTENSIONS)
+#Raised on reading a corrupt or truncated archive, besides IOError
+ARCHIVE_ERRORS = (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError) + ((lzma.LZMAError,) if lzma else ())
 
 """Generates the number of possible elements based off the given schemas"""
-def get_total_possible_elements(schemas = None):
-    global g_schemas
-    if not schemas:
-        schemas = g_schemas
-    children_count = 0
-    for schema in schemas.values():
-        children_count += len(schema.tree.getroot().xpath("//xsd:complexType//xsd:element/@name",
-                                namespaces={"xsd" : "http://www.w3.org/2001/XMLSchema"}))
-        children_count += len(schema.tree.getroot().xpath("//xsd:complexType//xsd:element/@ref",
-                                namespaces={"xsd" : "http://www.w3.org/2001/XMLSchema"}))
-    return children_count
+def get_total_possible_elements(schemas):
+    return schemas.get_total('element_count')
 
 """Generates the number of possible attributes based off the given schemas"""
-def get_total_possible_attributes(schemas = None):
-    global g_schemas
-    if not schemas:
-        schemas = g_schemas
-    attrib_count = 0
-    for schema in  schemas.values():
-        attrib_count += len(schema.tree.getroot().xpath("//xsd:complexType//xsd:attribute/@name",
-                            namespaces={"xsd" : "http://www.w3.org/2001/XMLSchema"}))
-        attrib_count += len(schema.tree.getroot().xpath("//xsd:complexType//xsd:attribute/@ref",
-                            namespaces={"xsd" : "http://www.w3.org/2001/XMLSchema"}))
-    return attrib_count
+def get_total_possible_attributes(schemas):
+    return schemas.get_total('attribute_count')
+
+"""Generates a content hash of the given XSD files, in the order they are loaded"""
+def get_schema_fingerprint(xsd_files):
+    digest = hashlib.sha1(str(SCHEMA_CACHE_VERSION))
+    for sfile in xsd_files:
+        content = sfile.read()
+        sfile.seek(0)
+        digest.update(hashlib.sha1(content).digest())
+    return digest.hexdigest()
+
+"""Converts a numpy scalar to the equivalent plain Python number"""
+def to_python(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
 
 """trim {namespace} from a string"""
 def trim_namespace(to_trim):
@@ -50,45 +103,300 @@ def get_namespace(to_trim, analytic = None):
     if '}' in to_trim:
         return to_trim.split('}')[0][1:]
     elif ':' in to_trim and analytic is not None:
-        return analytic.stix.tree.getroot().nsmap[to_trim.split(':')[0]]
+        return analytic.stix.nsmap[to_trim.split(':')[0]]
     elif ':' in to_trim:
         return to_trim.split(':')[0]
     else:
         return to_trim
     
+"""Loads the given open XSD files into a new SchemaContext, from the compiled schema cache at
+cache_path when it was built from the same XSD contents. Together with analyze_file this is the
+library interface: a context is loaded once and shared by every analysis, including analyses
+running at the same time in different threads"""
+def load_context(xsd_files, cache_path=None):
+    context = SchemaContext()
+    context.load_schemas(xsd_files, cache_path)
+    return context
+
+"""Runs the analytics on a single open input file against the schemas of context. With coverage
+the Analytic also records which of the possible elements and attributes the file used"""
+def analyze_file(ifile, context, stream=False, detail=False, sample=None, coverage=False):
+    if stream:
+        analytic = Analytic(StixStream(ifile), context, sample=sample, coverage=coverage)
+    else:
+        with profile_phase('parse'):
+            stix = StixInput(ifile)
+        analytic = Analytic(stix, context, detail, sample, coverage)
+    with profile_phase('set_schemas'):
+        analytic.set_schemas(context.schemas)
+    analytic.process_stix_tree()
+    return analytic
+
+"""Opens, analyzes and closes the named file, returning None if it cannot be read or parsed.
+Files whose content was already analyzed against the same schemas come from result_cache.
+This is also the worker entry point for --jobs: workers are forked once g_context has been
+warmed, see SchemaContext.warm, so its schemas and lookups are shared copy-on-write"""
+def analyze_file_job(task):
+    global g_context
+    source, stream, detail, result_cache, sample, coverage = task
+    try:
+        if isinstance(source, ArchiveMember):
+            return analyze_cached(source, g_context, stream, detail, result_cache, sample, coverage)
+        with open(source, 'r') as ifile:
+            return analyze_cached(ifile, g_context, stream, detail, result_cache, sample, coverage)
+    except (IOError, KeyError, etree.XMLSyntaxError) + ARCHIVE_ERRORS as e:#KeyError: a namespace without a loaded schema
+        logging.error("Skipping " + getattr(source, 'name', source) + ": " + str(e))
+        return None
+
+"""Runs analyze_file_job with a fresh g_profile that is attached to the returned Analytic for the
+parent process to merge, so that --profile also covers the work done by --jobs worker processes"""
+def profiled_file_job(task):
+    global g_profile
+    run_profile = g_profile
+    g_profile = Profile()
+    try:
+        analytic = analyze_file_job(task)
+    finally:
+        file_profile, g_profile = g_profile, run_profile
+    if analytic is not None:
+        analytic.profile = file_profile
+    return analytic
+
+"""Analyzes a document submitted to the server, the worker entry point for --serve --jobs"""
+def analyze_document_job(task):
+    global g_context
+    document, stream, result_cache, sample = task
+    ifile = StringIO.StringIO(document)
+    ifile.name = SUBMITTED_NAME
+    try:
+        return analyze_cached(ifile, g_context, stream, False, result_cache, sample)
+    except (KeyError, etree.XMLSyntaxError) as e:
+        logging.error("Skipping submitted document: " + str(e))
+        return None
+
+"""Analyzes an open input file, reusing the result for the same content from result_cache if given"""
+def analyze_cached(ifile, context, stream=False, detail=False, result_cache=None, sample=None, coverage=False):
+    if result_cache is None:
+        return analyze_file(ifile, context, stream, detail, sample, coverage)
+    with profile_phase('result_cache'):
+        key = result_cache.get_key(ifile)
+        analytic = result_cache.get(key)
+        if analytic is not None and coverage and analytic.coverage is None:
+            analytic = None#cached without --coverage
+    profile_lookup('result_cache', analytic is not None)
+    if analytic is not None:
+        analytic.stats.filename = ifile.name#the same content may be cached under another name
+        return analytic
+    analytic = analyze_file(ifile, context, stream, detail, coverage=coverage)
+    result_cache.put(key, analytic)
+    return analytic
+
+"""Times the enclosed block as a phase of g_profile, if profiling. Phases nest, e.g. closure time
+is also part of walk, which for streamed input includes the parsing"""
+@contextlib.contextmanager
+def profile_phase(phase):
+    global g_profile
+    profile = g_profile
+    if profile is None:
+        yield
+        return
+    wall, cpu = time.time(), get_cpu_time()
+    try:
+        yield
+    finally:
+        profile.add_phase(phase, time.time() - wall, get_cpu_time() - cpu)
+
+"""Counts a hit or miss of the named cache in g_profile, if profiling"""
+def profile_lookup(cache, hit):
+    global g_profile
+    if g_profile is not None:
+        g_profile.add_lookup(cache, hit)
+
+"""Returns the user plus system CPU seconds used by this process"""
+def get_cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+"""Leaves interrupting to the parent process, which shuts its --serve worker processes down itself"""
+def ignore_interrupt():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+"""Handles SIGTERM like an interrupt, so that a server stopped by a service manager cleans up too"""
+def raise_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+"""Lazily expands the given paths into input files: directories are listed (and descended
+into when recursive), glob patterns are matched and anything else is passed through as is.
+Listings and matches are sorted, so files are always analyzed and reported in the same order"""
+def iter_input_files(paths, recursive=False):
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    yield os.path.join(dirpath, filename)
+                if not recursive:
+                    break
+        elif glob.has_magic(path):
+            for filename in sorted(glob.glob(path)):
+                if os.path.isfile(filename):
+                    yield filename
+        else:
+            yield path
+
+"""Removes the socket at path if it was left behind by a server that did not shut down cleanly. Raises
+IOError if anything else is there, be it another kind of file or the socket of a server still running"""
+def remove_stale_socket(path):
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return#nothing there
+    if not stat.S_ISSOCK(mode):
+        raise IOError(path + " already exists and is not a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno != errno.ECONNREFUSED:
+            raise IOError(path + " could not be checked: " + str(e))
+        os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise IOError("another server is already serving on " + path)
+
+"""Returns true if the path names an archive or compressed file, going by its extension"""
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+"""Replaces each archive among the input files by its members, leaving other files as their names.
+Members are read into memory first when buffered, as they must be to be hashed for a result cache or
+sent to a worker process; otherwise each is parsed straight from the archive before the next is read.
+Archives that cannot be read to the end are added to skipped, if given"""
+def iter_sources(filenames, buffered=False, skipped=None):
+    for filename in filenames:
+        if not is_archive(filename):
+            yield filename
+            continue
+        try:
+            for member in iter_archive_members(filename):
+                yield member.buffer() if buffered else member
+        except (IOError,) + ARCHIVE_ERRORS as e:
+            logging.error("Skipping the rest of " + filename + ": " + str(e))
+            if skipped is not None:
+                skipped.append(filename)
+
+"""Yields each regular file in the zip, tar (plain, gzip, bzip2 or xz compressed) or single compressed
+file at path as an ArchiveMember, decompressing on the fly. Tars are read as a stream, so a member can
+only be read until the next one is asked for, and nothing is ever extracted to disk"""
+def iter_archive_members(path):
+    if path.lower().endswith('.zip'):
+        with contextlib.closing(zipfile.ZipFile(path)) as archive:
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield ArchiveMember(path, info.filename, archive.open(info))
+        return
+    cfile = open_compressed(path)
+    try:
+        archive = tarfile.open(fileobj=cfile, mode='r|')
+    except tarfile.ReadError:
+        cfile.close()
+        if path.lower().endswith('.tar'):
+            raise
+        #A single compressed document, named as it was before being compressed
+        with contextlib.closing(open_compressed(path)) as cfile:
+            yield ArchiveMember(path, os.path.splitext(os.path.basename(path))[0], cfile)
+        return
+    with contextlib.closing(cfile):
+        for info in archive:
+            if info.isfile():
+                yield ArchiveMember(path, info.name, archive.extractfile(info))
+
+"""Opens a file for reading, decompressing it according to its extension"""
+def open_compressed(path):
+    extension = os.path.splitext(path.lower())[1]
+    if extension not in COMPRESSED_EXTENSIONS:
+        return open(path, 'rb')
+    if COMPRESSED_EXTENSIONS[extension] is None:
+        raise IOError("reading " + extension + " files needs backports.lzma")
+    return COMPRESSED_EXTENSIONS[extension](path, 'rb')
+
+"""A file inside an archive, named archive!member so that its results carry the archive's path. It is
+read from the decompressing archive as it is parsed, or from memory once buffered, which also lets it
+be rewound and pickled"""
+class ArchiveMember:
+    def __init__(self, archive, member, mfile):
+        self.name = archive + ARCHIVE_SEPARATOR + member
+        self.file = mfile
+
+    def read(self, size=-1):
+        if size < 0:
+            return self.file.read()#tar members cannot take a negative size
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    """Reads the rest of the member into memory"""
+    def buffer(self):
+        self.file = StringIO.StringIO(self.file.read())
+        return self
+    
 """"""
 class StixInput:
     def __init__(self, ifile):
         self.filename = ifile.name
-        self.tree = etree.parse(ifile)
+        self.tree = etree.parse(ifile, etree.XMLParser(huge_tree=True))#lifts libxml2's nesting depth limit
         logging.info('Generated input etree from' + ifile.name)        
-        if not self.check_if_stix(self.tree.getroot()):
-            logging.error("Input file" + self.tree.name + "is not a valid stix file")
-        self.root = self.tree.getroot()
+        self.set_root(self.tree.getroot())
+
+    """Records the root element and its namespace prefixes"""
+    def set_root(self, root):
+        if not self.check_if_stix(root):
+            logging.error("Input file " + self.filename + " is not a valid stix file")
+        self.root = root
+        self.nsmap = root.nsmap
         
     """Returns true if the file is a valid stix file"""
     def check_if_stix(self, input_root):
         qname = etree.QName(input_root)
-        return qname.namespace.startswith("http://stix.mitre.org")
+        return qname.namespace is not None and qname.namespace.startswith("http://stix.mitre.org")
+
+"""A STIX file read incrementally with iterparse instead of being held as a whole tree"""
+class StixStream(StixInput):
+    def __init__(self, ifile):
+        self.filename = ifile.name
+        self.file = ifile
+        self.tree = None
+        self.root = None
+        self.nsmap = {}
+
+    """Yields namespace declarations and element start/end events, the root is set on its start"""
+    def iterparse(self):
+        logging.info('Streaming input from ' + self.filename)
+        return etree.iterparse(self.file, events=('start-ns', 'start', 'end'), huge_tree=True)
             
+"""Counts for a single element while it is being walked, stored into its FileStats once finished"""
 class ElementStats:
-    def __init__(self, name, nid):
+    def __init__(self, name):
         self.name = name
-        self.id = nid
         self.attr_pres = 0
         self.attr_poss = 0
-        self.attr_ratio = 0.0
         self.direct_child_pres = 0
         self.direct_child_poss = 0
         self.recur_child_pres = 0
         self.recur_child_poss = 0
-        self.direct_child_ratio = 0.0
-        self.recur_child_ratio = 0.0
                 
 class FileStats:
-    def __init__(self, filename):
+    COLUMNS = ('type', 'attr_pres', 'attr_poss', 'direct_child_pres', 'direct_child_poss', 'recur_child_pres', 'recur_child_poss')
+
+    def __init__(self, filename, chunk_rows=None):
         self.filename = filename
-        self.element_stats = []
+        #Element statistics are held column-wise, one row per element and one typed array per count
+        self.columns = dict([(column, array.array('l')) for column in self.COLUMNS])
+        self.chunk_rows = chunk_rows#rows held before they are folded into type_totals, None to hold every row
+        self.type_ids = {}#element name -> the id stored in the 'type' column
+        self.type_names = []
         self.schema_count = 0
         self.el_count = 0
         self.attr_present = 0
@@ -96,91 +404,600 @@ class FileStats:
         self.attr_percent = 0.0
         self.overall_percent = 0.0
         self.type_stats = {}
+        self.type_totals = {}#element name -> TypeAccumulator, for merging into corpus statistics
+
+    """Returns true if the statistics of a starting element are to be worked out, which without
+    sampling they always are"""
+    def sample_element(self, node):
+        return True
+
+    """Appends the counts of a finished element as a new row"""
+    def add_element(self, el_stat):
+        if el_stat.name not in self.type_ids:
+            self.type_ids[el_stat.name] = len(self.type_names)
+            self.type_names.append(el_stat.name)
+        self.columns['type'].append(self.type_ids[el_stat.name])
+        self.columns['attr_pres'].append(el_stat.attr_pres)
+        self.columns['attr_poss'].append(el_stat.attr_poss)
+        self.columns['direct_child_pres'].append(el_stat.direct_child_pres)
+        self.columns['direct_child_poss'].append(el_stat.direct_child_poss)
+        self.columns['recur_child_pres'].append(el_stat.recur_child_pres)
+        self.columns['recur_child_poss'].append(el_stat.recur_child_poss)
+        if self.chunk_rows and len(self.columns['type']) >= self.chunk_rows:
+            self.fold_rows()
+
+    """Returns a column as a numpy array sharing the column's memory"""
+    def get_column(self, column):
+        return numpy.frombuffer(self.columns[column], dtype=numpy.dtype(self.columns[column].typecode))
+
+    """Returns the percentage pres/poss of every row, or 0 where nothing was possible"""
+    def get_ratio(self, pres, poss):
+        ratio = numpy.zeros(len(pres))
+        numpy.divide(pres * 100.0, poss, out=ratio, where=poss > 0)
+        return ratio
  
-    """Uses the dict containing information on each file to generate a set of analytics
-    on each type of tag present in the file"""
-    def generate_file_stats(self):     
-        self.el_count = len(self.element_stats)
-        #Generate the statistics for each element in filename
-    
-        types = {}
-        for el_stat in self.element_stats:
-            self.attr_present += el_stat.attr_pres 
-            #Generate ratios based on the information from previously geerated info 
-            if el_stat.attr_poss > 0:
-                el_stat.attr_percent = (el_stat.attr_pres / float(el_stat.attr_poss))*100
-            if el_stat.direct_child_poss > 0:
-                el_stat.direct_child_ratio = (el_stat.direct_child_pres / float(el_stat.direct_child_poss))*100            
-            if el_stat.recur_child_poss > 0:
-                el_stat.recur_child_ratio = (el_stat.recur_child_pres / float(el_stat.recur_child_poss))*100        
-                        
-            el_type = el_stat.name
-            if not types.has_key(el_type):
-                types[el_type] = {}
-            key = str(el_stat.id)
-            while types[el_type].has_key(key):
-                key += random.choice(string.letters)
-            types[el_type][key] = el_stat
-    
-        for el_type, el_val in types.iteritems():
-            #Generate min, max, and avg of the lists of number of children/attributes
-            attr_list = []
-            child_list = []
-            ratio_list = { 
-                          'attribs' : [],
-                          'd_child' : [],
-                          'r_child' : []
-                          }
+    """Folds the rows held so far into the per type totals, with one grouped reduction per
+    statistic, and starts again on empty columns"""
+    def fold_rows(self):
+        rows = len(self.columns['type'])
+        if rows == 0:
+            return
+        measures = self.get_measures()
+        self.el_count += rows
+        self.attr_present += int(measures['attr'].sum())
+        type_ids, counts, group = self.group_by_type()
+        sums = dict([(measure, group(values, numpy.add)) for measure, values in measures.iteritems()])
+        mins = dict([(measure, group(values, numpy.minimum)) for measure, values in measures.iteritems()])
+        maxes = dict([(measure, group(values, numpy.maximum)) for measure, values in measures.iteritems()])
+
+        for index, type_id in enumerate(type_ids):
+            totals = TypeAccumulator(counts[index])
+            for measure in TypeAccumulator.MEASURES:
+                totals.sums[measure] = sums[measure][index]
+                totals.mins[measure] = mins[measure][index]
+                totals.maxes[measure] = maxes[measure][index]
+            el_type = self.type_names[type_id]
+            if el_type in self.type_totals:
+                self.type_totals[el_type].merge(totals)
+            else:
+                self.type_totals[el_type] = totals
+        self.columns = dict([(column, array.array('l')) for column in self.COLUMNS])
+
+    """Generates a set of analytics on each type of tag present in the file from the per type
+    totals, once any rows still held have been folded into them"""
+    def generate_file_stats(self, schemas):     
+        self.fold_rows()
+        if self.el_count == 0:
+            return
+        for el_type in self.type_names:
+            totals = self.type_totals[el_type]
             self.type_stats[el_type] = {
-                                        'num_attr_pres': 0,
-                                        'num_direct_child_pres' : 0,
-                                        'num_recur_child_pres' : 0,
-                                        'count' : 0,
-                                        'attr_ratio' : 0.0,
-                                        'direct_child_ratio' : 0.0,
-                                        'recur_child_ratio' : 0.0,
-                                        'attr_max' : 0.0,
-                                        'child_max' : 0.0,
-                                        'attr_min' : 0.0,
-                                        'child_min' : 0.0,
-                                        'attr_avg' : 0.0,
-                                        'child_avg' : 0.0
+                                        'num_attr_pres': totals.sums['attr'],
+                                        'num_direct_child_pres' : totals.sums['direct_child'],
+                                        'num_recur_child_pres' : totals.sums['recur_child'],
+                                        'count' : totals.count,
+                                        'attr_ratio' : totals.mean('attr_ratio'),
+                                        'direct_child_ratio' : totals.mean('direct_child_ratio'),
+                                        'recur_child_ratio' : totals.mean('recur_child_ratio'),
+                                        'attr_max' : totals.maxes['attr'],
+                                        'child_max' : totals.maxes['direct_child'],
+                                        'attr_min' : totals.mins['attr'],
+                                        'child_min' : totals.mins['direct_child'],
+                                        'attr_avg' : totals.mean('attr'),
+                                        'child_avg' : totals.mean('direct_child')
                                         }
-    
-            for el_stat in el_val.itervalues():
-                self.type_stats[el_type]['count'] = self.type_stats[el_type]['count'] + 1
-                self.type_stats[el_type]['num_attr_pres'] += el_stat.attr_pres
-                self.type_stats[el_type]['num_direct_child_pres'] += el_stat.direct_child_pres
-                self.type_stats[el_type]['num_recur_child_pres'] += el_stat.recur_child_pres
-                attr_list.append(el_stat.attr_pres)
-                child_list.append(el_stat.direct_child_pres)
-                ratio_list['attribs'].append(el_stat.attr_percent)
-                ratio_list['d_child'].append(el_stat.direct_child_ratio)
-                ratio_list['r_child'].append(el_stat.recur_child_ratio)
-            
-            self.type_stats[el_type]['attr_ratio'] = average(ratio_list['attribs'])
-            self.type_stats[el_type]['direct_child_ratio'] = average(ratio_list['d_child'])
-            self.type_stats[el_type]['recur_child_ratio'] = average(ratio_list['r_child'])
-            self.type_stats[el_type]['attr_max'] = max(attr_list)
-            self.type_stats[el_type]['child_max'] = max(child_list)
-            self.type_stats[el_type]['attr_min'] = min(attr_list)
-            self.type_stats[el_type]['child_min'] = min(child_list)
-            self.type_stats[el_type]['attr_avg'] = average(attr_list)
-            self.type_stats[el_type]['child_avg'] = average(child_list)
-            
-        #Get overall statistics for the file
-        self.attr_percent = (self.attr_present / float(get_total_possible_attributes()))*100
-        self.child_percent = (self.el_count / float(get_total_possible_elements()))*100
-        self.overall_percent = (self.el_count + self.attr_present) / float(get_total_possible_elements() + get_total_possible_attributes())*100
+        self.generate_file_percentages(schemas)
         logging.info("Statistics have been successfully generated")
 
+    """Returns every TypeAccumulator measure of every row"""
+    def get_measures(self):
+        attr_pres = self.get_column('attr_pres')
+        direct_child_pres = self.get_column('direct_child_pres')
+        recur_child_pres = self.get_column('recur_child_pres')
+        return {
+                'attr' : attr_pres,
+                'direct_child' : direct_child_pres,
+                'recur_child' : recur_child_pres,
+                'attr_ratio' : self.get_ratio(attr_pres, self.get_column('attr_poss')),
+                'direct_child_ratio' : self.get_ratio(direct_child_pres, self.get_column('direct_child_poss')),
+                'recur_child_ratio' : self.get_ratio(recur_child_pres, self.get_column('recur_child_poss'))
+                }
+
+    """Returns the type ids present among the rows, the number of rows of each and a function
+    folding a column of values with a ufunc over each of those type's rows"""
+    def group_by_type(self):
+        #Sort the rows by type so each type is one contiguous run that reduceat can fold
+        types = self.get_column('type')
+        order = numpy.argsort(types, kind='mergesort')
+        ordered = types[order]
+        starts = numpy.append(0, numpy.flatnonzero(ordered[1:] != ordered[:-1]) + 1)
+        counts = numpy.diff(numpy.append(starts, len(types)))
+        return ordered[starts], counts, lambda values, ufunc: ufunc.reduceat(values[order], starts)
+
+    """Works out the file's share of the possible elements and attributes of the given schemas"""
+    def generate_file_percentages(self, schemas):
+        possible_elements = get_total_possible_elements(schemas)
+        possible_attributes = get_total_possible_attributes(schemas)
+        self.attr_percent = (self.attr_present / float(possible_attributes))*100
+        self.child_percent = (self.el_count / float(possible_elements))*100
+        self.overall_percent = (self.el_count + self.attr_present) / float(possible_elements + possible_attributes)*100
+
+"""FileStats estimated from a sample of about fraction of the elements. Whether an element is sampled
+is decided as it starts, independently of its ancestors so that deeply nested types are sampled as
+often as any other, and the first element of each tag always is so that every type gets estimates.
+Elements left out are only counted, without any lookup or statistics work. Per type sums are scaled
+up from the sample means, min and max are those of the sample, and each mean and sum gets a <key>_ci
+entry with the half-width of its confidence interval, along with the number 'sampled'"""
+class SampledFileStats(FileStats):
+    ESTIMATES = {#type_stats key -> measure, and whether it is a sum rather than a mean
+                 'num_attr_pres' : ('attr', True),
+                 'num_direct_child_pres' : ('direct_child', True),
+                 'num_recur_child_pres' : ('recur_child', True),
+                 'attr_ratio' : ('attr_ratio', False),
+                 'direct_child_ratio' : ('direct_child_ratio', False),
+                 'recur_child_ratio' : ('recur_child_ratio', False),
+                 'attr_avg' : ('attr', False),
+                 'child_avg' : ('direct_child', False)
+                 }
+
+    def __init__(self, filename, fraction, chunk_rows=None):
+        FileStats.__init__(self, filename, chunk_rows)
+        self.fraction = fraction
+        self.random = random.Random(SAMPLE_SEED)
+        self.tag_counts = {}#tag -> elements seen, sampled or not
+        self.total_attr_present = 0
+        self.squares = {}#element name -> measure -> sum of the squares of the sampled values
+
+    """Counts a starting element and returns true if it is to be sampled"""
+    def sample_element(self, node):
+        tag = node.tag
+        seen = self.tag_counts.get(tag, 0)
+        self.tag_counts[tag] = seen + 1
+        self.total_attr_present += len(node.attrib)
+        return seen == 0 or self.random.random() < self.fraction
+
+    """Sums the squares of the sampled rows for the confidence intervals before folding them"""
+    def fold_rows(self):
+        if len(self.columns['type']) == 0:
+            return
+        measures = self.get_measures()
+        type_ids, counts, group = self.group_by_type()
+        for measure, values in measures.iteritems():
+            squares = group(values * values.astype(float), numpy.add)
+            for index, type_id in enumerate(type_ids):
+                type_squares = self.squares.setdefault(self.type_names[type_id], {})
+                type_squares[measure] = type_squares.get(measure, 0.0) + squares[index]
+        FileStats.fold_rows(self)
+
+    def generate_file_stats(self, schemas):
+        FileStats.generate_file_stats(self, schemas)
+        type_counts = {}
+        for tag, count in self.tag_counts.iteritems():
+            el_type = trim_namespace(tag)
+            type_counts[el_type] = type_counts.get(el_type, 0) + count
+        for el_type in self.type_names:
+            count = type_counts[el_type]
+            totals = self.type_totals[el_type]
+            stats = self.type_stats[el_type]
+            sampled = totals.count
+            #the sample's means stand for the whole type, its sums are scaled up to the elements seen
+            means = dict([(measure, totals.mean(measure)) for measure in TypeAccumulator.MEASURES])
+            totals.count = count
+            for measure in TypeAccumulator.MEASURES:
+                totals.sums[measure] = means[measure] * count
+            stats['count'] = count
+            stats['sampled'] = sampled
+            for key, (measure, is_sum) in self.ESTIMATES.iteritems():
+                ci = self.get_interval(self.squares[el_type][measure], means[measure], sampled, count)
+                stats[key] = totals.sums[measure] if is_sum else means[measure]
+                stats[key + '_ci'] = ci * count if is_sum and ci is not None else ci
+        self.el_count = sum(self.tag_counts.itervalues())
+        self.attr_present = self.total_attr_present
+        self.generate_file_percentages(schemas)
+
+    """Returns the confidence interval half-width of a mean estimated from n of count elements, with the
+    finite population correction, so it is 0 once every element of the type was sampled and None
+    while a single sampled element says nothing of the spread"""
+    def get_interval(self, sum_squares, mean, n, count):
+        if n >= count:
+            return 0.0
+        if n < 2:
+            return None
+        variance = max(sum_squares - n * mean * mean, 0.0) / (n - 1)
+        return SAMPLE_Z * (variance / n * (count - n) / (count - 1.0)) ** 0.5
+
+"""Mergeable totals of each measure over the elements of one type: the count of elements and
+the sum, min and max of every measure (and so its mean). Totals from different files, worker
+processes or runs combine without revisiting any element"""
+class TypeAccumulator:
+    MEASURES = ('attr', 'direct_child', 'recur_child', 'attr_ratio', 'direct_child_ratio', 'recur_child_ratio')
+
+    def __init__(self, count=0):
+        self.count = count
+        self.sums = dict.fromkeys(self.MEASURES, 0)
+        self.mins = dict.fromkeys(self.MEASURES, None)
+        self.maxes = dict.fromkeys(self.MEASURES, None)
+
+    """Folds another accumulator's totals into this one"""
+    def merge(self, other):
+        self.count += other.count
+        for measure in self.MEASURES:
+            self.sums[measure] += other.sums[measure]
+            if self.mins[measure] is None or other.mins[measure] < self.mins[measure]:
+                self.mins[measure] = other.mins[measure]
+            if self.maxes[measure] is None or other.maxes[measure] > self.maxes[measure]:
+                self.maxes[measure] = other.maxes[measure]
+
+    def mean(self, measure):
+        if self.count == 0:
+            return 0.0
+        return self.sums[measure] / float(self.count)
+
+    """Returns the totals as plain numbers for saving"""
+    def to_dict(self):
+        plain = lambda values: dict([(measure, to_python(value)) for measure, value in values.iteritems()])
+        return {
+                'count' : to_python(self.count),
+                'sums' : plain(self.sums),
+                'mins' : plain(self.mins),
+                'maxes' : plain(self.maxes)
+                }
+
+    def from_dict(self, totals):
+        self.count = totals['count']
+        self.sums.update(totals['sums'])
+        self.mins.update(totals['mins'])
+        self.maxes.update(totals['maxes'])
+        return self
+
+"""Per type totals over a whole corpus of files, which can be saved, loaded and merged so that
+coverage statistics are kept up to date by only analyzing the new files"""
+class CorpusStats:
+    def __init__(self):
+        self.files = 0
+        self.el_count = 0
+        self.attr_present = 0
+        self.types = {}#element name -> TypeAccumulator
+
+    """Adds the totals of one analyzed file"""
+    def add_file_stats(self, stats):
+        self.files += 1
+        self.el_count += stats.el_count
+        self.attr_present += stats.attr_present
+        for el_type, totals in stats.type_totals.iteritems():
+            self.types.setdefault(el_type, TypeAccumulator()).merge(totals)
+
+    """Folds another corpus's totals into this one"""
+    def merge(self, other):
+        self.files += other.files
+        self.el_count += other.el_count
+        self.attr_present += other.attr_present
+        for el_type, totals in other.types.iteritems():
+            self.types.setdefault(el_type, TypeAccumulator()).merge(totals)
+
+    def to_dict(self):
+        return {
+                'files' : self.files,
+                'el_count' : self.el_count,
+                'attr_present' : self.attr_present,
+                'types' : dict([(el_type, totals.to_dict()) for el_type, totals in self.types.iteritems()])
+                }
+
+    """Merges the corpus saved at path into this one"""
+    def load(self, path):
+        with open(path, 'r') as cfile:
+            saved = json.load(cfile)
+        other = CorpusStats()
+        other.files = saved['files']
+        other.el_count = saved['el_count']
+        other.attr_present = saved['attr_present']
+        for el_type, totals in saved['types'].iteritems():
+            other.types[el_type] = TypeAccumulator().from_dict(totals)
+        self.merge(other)
+        logging.info("Merged corpus statistics from " + path)
+
+    """Writes the corpus to path, replacing it atomically"""
+    def save(self, path):
+        with open(path + '.tmp', 'w') as cfile:
+            json.dump(self.to_dict(), cfile, indent=1, sort_keys=True)
+        os.rename(path + '.tmp', path)
+        logging.info("Saved corpus statistics to " + path)
+
+"""Directory of pickled per-file results, keyed by a hash of the file's content and of the
+schemas it was analyzed against, so unchanged inputs are not parsed again. Entries are
+evicted least recently used first once there are more than max_entries or max_bytes of them"""
+class ResultCache:
+    def __init__(self, path, fingerprint, max_entries=RESULT_CACHE_ENTRIES, max_bytes=RESULT_CACHE_BYTES):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    """Hashes the content of an open file, leaving it rewound for parsing"""
+    def get_key(self, ifile):
+        content = hashlib.sha1()
+        for chunk in iter(lambda: ifile.read(1 << 20), ''):
+            content.update(chunk)
+        ifile.seek(0)
+        digest = hashlib.sha1(str(RESULT_CACHE_VERSION) + self.fingerprint)
+        digest.update(content.digest())
+        return digest.hexdigest()
+
+    def get_entry_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    """Returns the cached Analytic for key, or None if there is no usable entry"""
+    def get(self, key):
+        entry_path = self.get_entry_path(key)
+        try:
+            with open(entry_path, 'rb') as cfile:
+                analytic = cPickle.load(cfile)
+            os.utime(entry_path, None)#mark as recently used for eviction
+            return analytic
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            logging.info("Result cache entry " + entry_path + " could not be read: " + str(e))
+            return None
+
+    """Stores an Analytic under key, replacing any entry atomically"""
+    def put(self, key, analytic):
+        entry_path = self.get_entry_path(key)
+        tmp_path = entry_path + '.' + str(os.getpid()) + '.tmp'
+        try:
+            if not os.path.isdir(os.path.dirname(entry_path)):
+                os.makedirs(os.path.dirname(entry_path))
+            with open(tmp_path, 'wb') as cfile:
+                cPickle.dump(analytic, cfile, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, entry_path)
+        except (IOError, OSError) as e:
+            logging.warning("Result cache entry " + entry_path + " could not be written: " + str(e))
+
+    """Removes the least recently used entries until the cache is within its limits"""
+    def evict(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue#still being written by put
+                entry_path = os.path.join(dirpath, filename)
+                try:
+                    info = os.stat(entry_path)
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry_path))
+        entries.sort(reverse=True)
+        count = 0
+        total = 0
+        for mtime, size, entry_path in entries:
+            count += 1
+            total += size
+            if count > self.max_entries or total > self.max_bytes:
+                try:
+                    os.remove(entry_path)
+                except OSError:
+                    pass
+
+"""Wall and CPU time per phase and hit/miss counts per cache for --profile. A Profile is collected
+per file by each --jobs worker (see profiled_file_job) and merged into the run's one"""
+class Profile:
+    def __init__(self):
+        self.phases = {}#phase -> [wall seconds, cpu seconds, times entered]
+        self.lookups = {}#cache name -> [hits, misses]
+        self.counters = {}
+
+    def add_phase(self, phase, wall, cpu):
+        totals = self.phases.setdefault(phase, [0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += 1
+
+    def add_lookup(self, cache, hit):
+        self.lookups.setdefault(cache, [0, 0])[0 if hit else 1] += 1
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    """Folds the timings and counts of another Profile, e.g. a worker's, into this one"""
+    def merge(self, other):
+        for phase, (wall, cpu, calls) in other.phases.iteritems():
+            totals = self.phases.setdefault(phase, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += calls
+        for cache, (hits, misses) in other.lookups.iteritems():
+            totals = self.lookups.setdefault(cache, [0, 0])
+            totals[0] += hits
+            totals[1] += misses
+        for counter, amount in other.counters.iteritems():
+            self.count(counter, amount)
+
+    def to_dict(self):
+        caches = {}
+        for cache, (hits, misses) in self.lookups.iteritems():
+            caches[cache] = {
+                             'hits' : hits,
+                             'misses' : misses,
+                             'hit_ratio' : hits / float(hits + misses) if hits + misses else None
+                             }
+        return {
+                'phases' : dict([(phase, {'wall' : wall, 'cpu' : cpu, 'calls' : calls})
+                                 for phase, (wall, cpu, calls) in self.phases.iteritems()]),
+                'caches' : caches,
+                'counters' : self.counters,
+                #ru_maxrss is in kilobytes on Linux, children covers the --jobs workers once they are joined
+                'peak_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                'peak_rss_children_kb' : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                }
+
+"""Interns each name used by the lookups as a small integer symbol, splitting it into its namespace and
+local name just once, so that the child, closure and attribute lookups hold and compare integers"""
+class SymbolTable:
+    def __init__(self):
+        self.symbols = {}#'{namespace}name' (or 'prefix:name', 'name') -> symbol
+        self.qnames = []#symbol -> name as interned
+        self.namespaces = []#symbol -> namespace (or prefix) as get_namespace gives it
+        self.local_names = []#symbol -> name without its namespace
+        self.lock = threading.Lock()#analyses sharing a SchemaContext intern from several threads
+
+    def intern(self, qname):
+        symbol = self.symbols.get(qname)
+        if symbol is None:
+            with self.lock:
+                symbol = self.symbols.get(qname)
+                if symbol is None:
+                    #the names are added before the symbol is published, so any symbol found can be looked up
+                    self.qnames.append(qname)
+                    self.namespaces.append(get_namespace(qname))
+                    self.local_names.append(trim_namespace(qname))
+                    symbol = self.symbols[qname] = len(self.qnames) - 1
+        return symbol
+
+    """Returns the names of the given symbols"""
+    def get_qnames(self, symbols):
+        return [self.qnames[symbol] for symbol in symbols]
+
+"""Gives every element and attribute name the loaded schemas declare a bit position, in name order so
+that the same schemas always give the same positions. Sets of names are then held as bitsets (plain
+ints), which makes unions, intersections and differences over many files single operations"""
+class CoverageMap:
+    def __init__(self, schemas):
+        elements = set()
+        attributes = set()
+        for namespace in schemas:
+            schema = schemas[namespace]
+            elements.update(['{' + namespace + '}' + name for name in schema.index.element_types])
+            for complex_type in schema.index.complex_types.itervalues():
+                elements.update(['{' + namespace + '}' + name for name in complex_type['elements']])
+                elements.update(['{%s}%s' % schema.resolve_qname(ref) for ref in complex_type['element_refs']])
+                attributes.update(complex_type['attributes'])
+                attributes.update(['{%s}%s' % schema.resolve_qname(ref) for ref in complex_type['attribute_refs']])
+        self.names = {'elements' : sorted(elements), 'attributes' : sorted(attributes)}
+        self.positions = dict([(kind, dict([(name, position) for position, name in enumerate(names)]))
+                               for kind, names in self.names.iteritems()])
+
+    """Returns the bitset of the given names of a kind ('elements' or 'attributes'), ignoring undeclared ones"""
+    def get_bits(self, names, kind):
+        positions = self.positions[kind]
+        bits = 0
+        for position in set([positions[name] for name in names if name in positions]):
+            bits |= 1 << position
+        return bits
+
+    """Returns the names whose bits are set, in name order"""
+    def get_names(self, bits, kind, names=None):
+        names = names or self.names[kind]
+        return [names[position] for position, bit in enumerate(bin(bits)[:1:-1]) if bit == '1']
+
+    """Returns the bitset with every name of a kind set"""
+    def get_all(self, kind):
+        return (1 << len(self.names[kind])) - 1
+
+"""Which of the possible elements and attributes were used by any file of a corpus, and which by
+every file, kept as CoverageMap bitsets that can be saved, merged and compared with another corpus"""
+class CoverageStats:
+    KINDS = ('elements', 'attributes')
+
+    def __init__(self, coverage_map):
+        self.map = coverage_map
+        self.files = 0
+        self.used = dict([(kind, 0) for kind in self.KINDS])#names used by any file
+        self.common = dict([(kind, None) for kind in self.KINDS])#names used by every file, None before the first
+
+    """Adds the (element bits, attribute bits) coverage of one analyzed file"""
+    def add_coverage(self, coverage):
+        self.add_bits(1, dict(zip(self.KINDS, coverage)), dict(zip(self.KINDS, coverage)))
+
+    """Folds another corpus's coverage into this one"""
+    def merge(self, other):
+        self.add_bits(other.files, other.used, other.common)
+
+    def add_bits(self, files, used, common):
+        self.files += files
+        for kind in self.KINDS:
+            self.used[kind] |= used[kind]
+            if common[kind] is not None:
+                self.common[kind] = common[kind] if self.common[kind] is None else self.common[kind] & common[kind]
+
+    """Returns the bitset of the names of a kind that no file has used"""
+    def get_unused(self, kind):
+        return self.map.get_all(kind) & ~self.used[kind]
+
+    """Returns how many names are set in a bitset"""
+    def count(self, bits):
+        return bin(bits or 0).count('1')
+
+    def to_dict(self):
+        return {
+                'files' : self.files,
+                'names' : self.map.names,
+                'used' : dict([(kind, hex(bits)) for kind, bits in self.used.iteritems()]),
+                'common' : dict([(kind, None if bits is None else hex(bits)) for kind, bits in self.common.iteritems()])
+                }
+
+    """Merges the coverage saved at path into this one, matching bits by name in case it was saved
+    against different schemas"""
+    def load(self, path):
+        with open(path, 'r') as cfile:
+            saved = json.load(cfile)
+        other = CoverageStats(self.map)
+        other.files = saved['files']
+        for kind in self.KINDS:
+            names = saved['names'][kind]
+            other.used[kind] = self.map.get_bits(self.map.get_names(long(saved['used'][kind], 16), kind, names), kind)
+            if saved['common'][kind] is not None:
+                other.common[kind] = self.map.get_bits(self.map.get_names(long(saved['common'][kind], 16), kind, names), kind)
+        self.merge(other)
+        logging.info("Merged coverage from " + path)
+
+    """Writes the coverage to path, replacing it atomically"""
+    def save(self, path):
+        with open(path + '.tmp', 'w') as cfile:
+            json.dump(self.to_dict(), cfile, sort_keys=True)
+        os.rename(path + '.tmp', path)
+        logging.info("Saved coverage to " + path)
+
 class Analytic:
-    def __init__(self, stix):
+    def __init__(self, stix, context, detail=False, sample=None, coverage=False):
+        if detail and sample:
+            raise ValueError("the per node detail covers every node and cannot be combined with sample")
         self.stix = stix
+        self.context = context#the SchemaContext analyzed against, only read from or filled in through its lookups
         self.schemas = {}
-        self.stats = FileStats(stix.filename)
+        chunk_rows = STREAM_CHUNK_ROWS if stix.tree is None else None#streamed input keeps only running totals
+        if sample:
+            self.stats = SampledFileStats(stix.filename, sample, chunk_rows)
+        else:
+            self.stats = FileStats(stix.filename, chunk_rows)
+        self.profile = None#set by profiled_file_job under --profile
+        self.coverage = None#(element bits, attribute bits) of the names seen, under --coverage
+        self.seen_elements = set() if coverage else None
+        self.seen_attributes = set() if coverage else None
+        self.detail = detail#Only counts are kept unless the per-node info is asked for, e.g. by --debug
         self.info = {}#Holds all relevant information from the stixinput files including children, attributes, and statistic
         logging.info('Generated Analytic ostix_reportbject')
+
+    """Only the results are sent back from --jobs workers, the input tree and schemas stay behind"""
+    def __getstate__(self):
+        return {
+                'stats' : self.stats,
+                'info' : self.info,
+                'schemas' : list(self.schemas),
+                'profile' : self.profile,
+                'coverage' : self.coverage
+                }
+
+    def __setstate__(self, state):
+        self.stix = None
+        self.context = None
+        self.stats = state['stats']
+        self.info = state['info']
+        self.profile = state.get('profile')
+        self.coverage = state.get('coverage')
+        self.seen_elements = self.seen_attributes = None
+        self.schemas = dict.fromkeys(state['schemas'])#only the namespaces used come back
     
     """Retrieve all the namespaces and schemalocations needed to validate
         `root`.
@@ -195,154 +1012,316 @@ class Analytic:
             Lifted from stix_validator.py
     """
     def set_schemas(self, schemas_to_check):
-        for elem in self.stix.root.iter():
-            for ns in elem.nsmap.itervalues():
-                if ns not in self.schemas and ns in schemas_to_check:
-                    self.schemas[ns] = schemas_to_check[ns]
-                    schemas_to_check[ns].is_used = True
+        if self.stix.tree is None:
+            #Streamed input is matched to schemas as its namespaces are declared, see process_stix_stream
+            return schemas_to_check
+        #Only the declarations are visited, rather than the namespaces every element inherits
+        for event, (prefix, ns) in etree.iterwalk(self.stix.root, events=('start-ns',)):
+            if ns not in self.schemas and ns in schemas_to_check:
+                self.schemas[ns] = schemas_to_check[ns]
         self.stats.schema_count = len(self.schemas)
         return schemas_to_check
                     
     """Starts analytics generation process"""                
     def process_stix_tree(self):
-        logging.debug("Input tree root is %s", self.stix.root.tag)
-        #for each child, populate the info_to_return dictionary
-        self.info = self.walk_stix(self.stix.root)
-        self.stats.generate_file_stats()          
-
-    """Given a node, recursively (and directly) populates the the properties of that node
-    and all of its children"""
-    def walk_stix(self, node, pnode=None):
-        name = trim_namespace(node.tag) 
-        if pnode is None:
-            nid = name
+        if self.stix.tree is None:
+            self.process_stix_stream()
         else:
-            nid = name + str(pnode.index(node)) #gives each child element a relatively unique identifier
-        stats = ElementStats(name, nid)
-        logging.debug("Subelement %s is of type: ", nid, name)
+            logging.debug("Input tree root is %s", self.stix.root.tag)
+            #for each child, populate the info_to_return dictionary when detail is asked for
+            with profile_phase('walk'):
+                self.info = self.walk_stix(self.stix.root) or {}
+            with profile_phase('file_stats'):
+                self.stats.generate_file_stats(self.context.schemas)
+        if self.seen_elements is not None:
+            coverage_map = self.context.get_coverage_map()
+            self.coverage = (coverage_map.get_bits(self.seen_elements, 'elements'),
+                             coverage_map.get_bits(self.seen_attributes, 'attributes'))
+            self.seen_elements = self.seen_attributes = None
+
+    """Generates the same statistics as walk_stix from an iterparse stream. Each element is
+    cleared (and detached from its parent) as soon as it ends, so only the currently open
+    path is held in memory; no per-node info is kept"""
+    def process_stix_stream(self):
+        with profile_phase('walk'):
+            self.walk_stix_stream()
+        with profile_phase('file_stats'):
+            self.stats.generate_file_stats(self.context.schemas)
+
+    def walk_stix_stream(self):
+        schemas = self.context.schemas
+        #Each frame holds: stats, number of child elements seen, number of descendants seen
+        stack = []
+        for event, item in self.stix.iterparse():
+            if event == 'start-ns':
+                #Streamed namespaces are matched to schemas as they are declared, see set_schemas
+                ns = item[1]
+                if ns not in self.schemas and ns in schemas:
+                    self.schemas[ns] = schemas[ns]
+                    self.stats.schema_count += 1
+            elif event == 'start':
+                if not stack:
+                    self.stix.set_root(item)
+                else:
+                    stack[-1][1] += 1
+                stack.append([self.start_node_stats(item), 0, 0])
+            else:
+                stats, direct_count, recur_count = stack.pop()
+                self.finish_node_stats(stats, direct_count, recur_count)
+                item.clear()
+                if stack:
+                    stack[-1][2] += recur_count + 1
+                    while item.getprevious() is not None:
+                        del item.getparent()[0]
+
+    """Given the root, populates the statistics (and, with detail, the properties) of that node
+    and all of its descendants. The walk keeps its own stack rather than recursing, so deep CybOX
+    nesting cannot hit the recursion limit; sibling ordinals come from counters and recursive
+    child counts are summed bottom-up as each subtree is finished"""
+    def walk_stix(self, root):
+        properties, stats = self.populate_node(root)
+        #Each frame holds: node, properties, stats, children left to visit, child count, descendant count, descendant tags
+        stack = [[root, properties, stats, enumerate(self.populate_present_children(root)), 0, 0, []]]
+        while stack:
+            frame = stack[-1]
+            for ordinal, child in frame[3]:
+                c_properties, c_stats = self.populate_node(child)
+                if self.detail:
+                    c_nid = trim_namespace(child.tag) + str(ordinal) #gives each child element a relatively unique identifier
+                    frame[1][c_nid] = c_properties
+                frame[4] += 1
+                stack.append([child, c_properties, c_stats, enumerate(self.populate_present_children(child)), 0, 0, []])
+                break
+            else:
+                node, properties, stats, children, direct_count, recur_count, recur_tags = stack.pop()
+                self.finish_node_stats(stats, direct_count, recur_count)
+                if stack:
+                    stack[-1][5] += recur_count + 1
+                if self.detail:
+                    properties['recur_child_pres'] = recur_tags
+                    if stack:
+                        stack[-1][6].append(node.tag)
+                        stack[-1][6].extend(recur_tags)
+        return properties
+
+    """Populates the statistics of a single node and, with detail, its properties, apart from
+    its recursive children which walk_stix fills in once the node's subtree is complete"""
+    def populate_node(self, node):
+        stats = self.start_node_stats(node)
+        if not self.detail:
+            return None, stats
         properties = {}
-        #Populate attribute based information including statistics
+        #Populate attribute based information
         properties['attr_pres'] = self.populate_present_attributes(node)
         properties['attr_poss'] = self.populate_possible_attributes(node)
-        stats.attr_pres = len(properties['attr_pres'])
-        stats.attr_poss = len(properties['attr_poss'])
-        if len(properties['attr_poss']) > 0:
+        if stats.attr_poss > 0:
             properties['attr_ratio'] = stats.attr_pres / float(stats.attr_poss)
-            
-        #Populate recursive and direct children based information including statistics
-        properties.update({ 'direct_child_pres' : self.populate_present_children(node)})
-        properties.update({ 'recur_child_pres' : self.get_present_children_recursively(node)})
+        #Populate direct children based information
+        properties.update({ 'direct_child_pres' : [child.tag for child in self.populate_present_children(node)]})
+        properties.update({ 'recur_child_pres' : None})
         properties.update({ 'recur_child_poss' : self.populate_possible_children(node)})
-        properties.update({ 'direct_child_poss' : list(self.get_legitimate_children(node.tag))})
+        symbols = self.context.symbols
+        properties.update({ 'direct_child_poss' : symbols.get_qnames(self.get_legitimate_children(symbols.intern(node.tag)))})
+        return properties, stats
 
-        
-        if len(properties['direct_child_poss']) > 0:
-            stats.direct_child_pres = len(properties['direct_child_pres'])
-            stats.recur_child_pres = len(properties['recur_child_pres'])
-            stats.direct_child_poss = len(properties['direct_child_poss'])
-            stats.recur_child_poss = len(properties['recur_child_poss'])
-            stats.direct_child_ratio = len(properties['direct_child_pres']) / float(len(properties['direct_child_poss']))
-            stats.recur_child_ratio = len(properties['recur_child_pres']) / float(len(properties['recur_child_poss']))
-            
-        self.stats.element_stats.extend([stats])
+    """Returns the statistics of a starting node, or None when --sample leaves it out, in which
+    case it is only counted (and recorded for --coverage)"""
+    def start_node_stats(self, node):
+        if self.stats.sample_element(node):
+            return self.populate_node_stats(node)
+        if self.seen_elements is not None:
+            self.seen_elements.add(node.tag)
+            self.seen_attributes.update(node.keys())
+        return None
 
-        #Recursively check subelements for children and attributes 
-        for child in node:
-            c_nid = trim_namespace(child.tag) + str(node.index(child))
-            properties[c_nid] = self.walk_stix(child, node)
-        logging.info("%s added to return dictionary", name)
-        return properties
+    """Generates the statistics of a single node that are known from its start tag; the present
+    child counts are added by finish_node_stats once the node's subtree has been read"""
+    def populate_node_stats(self, node):
+        name, attr_poss, direct_child_poss, recur_child_poss = self.context.get_lookup('node_lookup', self.get_type_key(node), self.get_node_counts)
+        stats = ElementStats(name)
+        stats.attr_pres = len(node.attrib)
+        stats.attr_poss = attr_poss
+        if self.seen_elements is not None:
+            self.seen_elements.add(node.tag)
+            self.seen_attributes.update(node.keys())
+        stats.direct_child_poss = direct_child_poss
+        stats.recur_child_poss = recur_child_poss
+        return stats
+
+    """Works out the name and the possible attribute, direct child and recursive child counts
+    shared by every node with the given (tag, xsi:type) key"""
+    def get_node_counts(self, key):
+        symbol = self.context.symbols.intern(key[0])
+        attr_poss = len(self.get_possible_attributes(key))
+        recur_child_poss = len(self.get_possible_children(key))
+        direct_child_poss = len(self.get_legitimate_children(symbol))
+        if direct_child_poss == 0:
+            recur_child_poss = 0
+        logging.debug("Element %s has %d possible attributes and %d possible children", key[0], attr_poss, direct_child_poss)
+        return self.context.symbols.local_names[symbol], attr_poss, direct_child_poss, recur_child_poss
+
+    """Adds the present direct and recursive child counts to a node's statistics"""
+    def finish_node_stats(self, stats, direct_count, recur_count):
+        if stats is None:
+            return#left out by --sample
+        if stats.direct_child_poss > 0:
+            stats.direct_child_pres = direct_count
+            stats.recur_child_pres = recur_count
+        self.stats.add_element(stats)
+        logging.info("%s added to return dictionary", stats.name)
     
-    """Gets the present subelements of the given child"""
-    def populate_present_children(self, node):        
-        return [child.tag for child in node]
+    """Gets the present subelements of the given node, skipping comments and processing instructions"""
+    def populate_present_children(self, node):
+        return node.iterchildren(tag=etree.Element)
     
     """Returns the trimmed version of a given node's attributes"""
     def populate_present_attributes(self, node):
         return [attr for attr in node.attrib]
     
-    """Sort of holder method for a recursive lookup of possible children"""
+    """Returns the names of the possible recursive children of a node"""
     def populate_possible_children(self, node):
-        global g_child_lookup
-        clist = set()
-        if node.tag not in g_child_lookup:
-            clist.update(self.get_legitimate_children(node.tag))
-        else: 
-            clist.update(g_child_lookup[node.tag])
-        if '{http://www.w3.org/2001/XMLSchema-instance}type' in node.attrib and node.attrib['{http://www.w3.org/2001/XMLSchema-instance}type'] not in g_child_lookup:
-            clist.update(self.get_legitimate_children(node.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']))
-        elif '{http://www.w3.org/2001/XMLSchema-instance}type' in node.attrib and node.attrib['{http://www.w3.org/2001/XMLSchema-instance}type'] in g_child_lookup: 
-            clist.update(g_child_lookup[node.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']])
-        
-        rlist = set()
-        while clist:
-            child = clist.pop()
-            if child not in g_child_lookup:
-                self.get_legitimate_children(child)
-            if len(g_child_lookup[child]) and child not in rlist:
-                clist.update(g_child_lookup[child])
-            rlist.add(child)
-        return list(rlist)
+        return self.context.symbols.get_qnames(self.get_possible_children(self.get_type_key(node)))
+
+    """Looks up the possible recursive children of a node, computed once per (tag, xsi:type)"""
+    def get_possible_children(self, key):
+        return self.context.get_lookup('possible_children_lookup', key, self.find_possible_children)
+
+    def find_possible_children(self, key):
+        symbols = self.context.symbols
+        rlist = set(self.get_possible_descendants(symbols.intern(key[0])))
+        if key[1] is not None:
+            rlist.update(self.get_possible_descendants(symbols.intern(key[1])))
+        return frozenset(rlist)
+
+    """Returns the (tag, xsi:type) key a node's possible children are cached under,
+    with a prefixed xsi:type expanded to {namespace}name using the node's own nsmap"""
+    def get_type_key(self, node):
+        xsi_type = node.get(XSI_TYPE)
+        if xsi_type is not None and ':' in xsi_type:
+            prefix, local = xsi_type.split(':', 1)
+            if prefix in node.nsmap:
+                xsi_type = '{' + node.nsmap[prefix] + '}' + local
+        return (node.tag, xsi_type)
+
+    """Returns the symbols of every element that may appear anywhere beneath the given element or type symbol.
+    Closures are computed per strongly connected component of the child graph (so recursive
+    content models are handled in one pass) and kept in the context's closure_lookup"""
+    def get_possible_descendants(self, symbol):
+        closure_lookup = self.context.lookups['closure_lookup']
+        profile_lookup('closure_lookup', symbol in closure_lookup)
+        if symbol in closure_lookup:
+            return closure_lookup[symbol]
+        with self.context.lock:
+            if symbol in closure_lookup:
+                return closure_lookup[symbol]#closed by another thread meanwhile
+            with profile_phase('closure'):
+                return self.close_descendants(symbol)
+
+    """Computes and stores the closures of every component reachable from symbol, see get_possible_descendants.
+    Each closure is stored as soon as its component is complete, so other analyses can use it straight away"""
+    def close_descendants(self, symbol):
+        child_lookup = self.context.lookups['child_lookup']
+        closure_lookup = self.context.lookups['closure_lookup']
+        #Iterative Tarjan: order/lowlink per visited symbol, scc_stack holds the open components
+        order = {symbol : 0}
+        lowlink = {symbol : 0}
+        scc_stack = [symbol]
+        on_stack = set([symbol])
+        work = [(symbol, iter(self.get_legitimate_children(symbol)))]
+        while work:
+            parent, children = work[-1]
+            for child in children:
+                if child in closure_lookup:
+                    continue
+                if child not in order:
+                    order[child] = lowlink[child] = len(order)
+                    scc_stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(self.get_legitimate_children(child))))
+                    break
+                if child in on_stack:
+                    lowlink[parent] = min(lowlink[parent], order[child])
+            else:
+                work.pop()
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[parent])
+                if lowlink[parent] != order[parent]:
+                    continue
+                #parent roots a component, every member of it can reach the same descendants
+                component = set()
+                while parent not in component:
+                    member = scc_stack.pop()
+                    on_stack.discard(member)
+                    component.add(member)
+                descendants = set()
+                for member in component:
+                    for child in child_lookup[member]:
+                        descendants.add(child)
+                        if child not in component:
+                            descendants.update(closure_lookup[child])
+                descendants = frozenset(descendants)
+                for member in component:
+                    closure_lookup[member] = descendants
+        return closure_lookup[symbol]
     
-    def get_legitimate_children(self, element_name):
-        global g_child_lookup
-        
-        name = trim_namespace(element_name)
-        namespace = get_namespace(element_name, self) #converts namespace from XXXXX: format to {XXXXX} format
-                
-        if element_name in g_child_lookup:
-            return g_child_lookup[element_name]
-        else:
-            g_child_lookup[element_name] = set()
+    def get_legitimate_children(self, symbol):
+        return self.context.get_lookup('child_lookup', symbol, self.find_legitimate_children)
+
+    def find_legitimate_children(self, symbol):
+        schemas = self.context.schemas
+        symbols = self.context.symbols
+        legit_children = set()
+        name = symbols.local_names[symbol]
+        namespace = symbols.namespaces[symbol]
         
-        #Find the appropriate schema for this element
+        #Find the appropriate schema for this element, a prefixed namespace is mapped by set_schema
         schema = self.set_schema(namespace)
+        namespace = schema.namespace
         nsmap = self.update_nsmap(schema)
         el_type = self.get_element_type(schema, nsmap, name)
         
-        #Tweak the name for better looking up     
+        #Tweak the name for better looking up, the type is looked for in whichever loaded schema
+        #declares it so that the cached result never depends on what this file has touched so far
         if len(el_type):
-            el_type = el_type.pop()
-            el_ns = get_namespace(el_type)
-            el_ns = nsmap[el_ns]
-            el_type = trim_namespace(el_type)
-            if el_ns != namespace and el_ns in self.schemas:
-                schema = self.schemas[el_ns]
+            el_ns, el_type = schema.resolve_qname(el_type.pop())
+            if el_ns != namespace and el_ns in schemas:
+                schema = schemas[el_ns]
+                nsmap = schema.nsmap
         else:
             el_type = name        
         
         children = self.get_children_names(schema, nsmap, el_type)
         for child in children:
             c_ns_and_name = '{' + schema.namespace + '}' + child
-            g_child_lookup[element_name].update([c_ns_and_name])
+            legit_children.add(symbols.intern(c_ns_and_name))
         
-        self.set_extended_children(element_name, schema, nsmap, el_type)
-        return g_child_lookup[element_name]
+        self.set_extended_children(legit_children, schema, nsmap, el_type)
+        return legit_children
     
-    """Uses a stack to iterate recursively over the present children starting from the given node"""
-    def get_present_children_recursively(self, node):
-        clist = node.iterdescendants();
-        rlist = []
-        #for each child present, pop it off the stack, add any subchildren it may have, and then add it to a list of all legitimate children
-        for child in clist:
-            rlist.append(child.tag)
-        return rlist     
-    
-    """Based off the current node, we use a filter to find the possible attributes given a node"""
+    """Returns the names of the possible attributes of a node"""
     def populate_possible_attributes(self, node):
-        legit_attrib = set()
-        legit_attrib.update(self.get_legitimate_attributes(node.tag))#lists all legitimate children of that tag 
-        if '{http://www.w3.org/2001/XMLSchema-instance}type' in node.attrib:
-            legit_attrib.update(self.get_legitimate_attributes(node.attrib['{http://www.w3.org/2001/XMLSchema-instance}type']))
-        return list(legit_attrib) 
+        return self.context.symbols.get_qnames(self.get_possible_attributes(self.get_type_key(node)))
+
+    """Looks up the possible attributes of a node, computed once per (tag, xsi:type)"""
+    def get_possible_attributes(self, key):
+        return self.context.get_lookup('possible_attributes_lookup', key, self.find_possible_attributes)
+
+    def find_possible_attributes(self, key):
+        symbols = self.context.symbols
+        legit_attrib = set(self.get_legitimate_attributes(symbols.intern(key[0])))
+        if key[1] is not None:
+            legit_attrib.update(self.get_legitimate_attributes(symbols.intern(key[1])))
+        return frozenset(legit_attrib)
             
-    """Uses a set of XPATH queries to generate a list of possible direct atributes from the schema"""
-    def get_legitimate_attributes(self, element_name):
-        global g_schemas
-        name = trim_namespace(element_name)
-        namespace = get_namespace(element_name, self)
-        attr_list = set()
-        bases = set()
+    """Generates the set of possible attributes of an element (or type) from the schema index,
+    including those inherited through its base types"""
+    def get_legitimate_attributes(self, symbol):
+        return self.context.get_lookup('attribute_lookup', symbol, self.find_legitimate_attributes)
+
+    def find_legitimate_attributes(self, symbol):
+        symbols = self.context.symbols
+        name = symbols.local_names[symbol]
+        namespace = symbols.namespaces[symbol]
         
         #Find the appropriate schema for this element
         schema = self.set_schema(namespace)
@@ -350,69 +1329,70 @@ class Analytic:
         el_type = self.get_element_type(schema, nsmap, name)
         #Tweak the name for better looking up     
         if len(el_type):
-            el_type = el_type.pop()
-            el_ns = get_namespace(el_type)
-            el_ns = nsmap[el_ns]
-            el_type = trim_namespace(el_type)
-            if el_ns != namespace and el_ns in self.schemas:
-                schema = self.schemas[el_ns]
+            el_ns, el_type = schema.resolve_qname(el_type.pop())
         else:
-            el_type = name        
-                
-        attr_list.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:attribute/@name",
-                                    namespaces=nsmap, n = el_type))
-        attr_list.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:attribute/@ref",
-                                    namespaces = nsmap, n = el_type))
-        attr_list.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:attributeGroup/@ref",
-                                namespaces=nsmap, n = el_type))
-        #If a given element extends another, get the valid subelement of the element being extended
-        bases.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:extension/@base",
-                                namespaces=nsmap, n = el_type))
-        bases.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:restriction/@base",
-                                namespaces=nsmap, n = el_type))
-        if len(bases):
-            for base in bases:
-                b_ns = get_namespace(base)
-                if b_ns in g_schemas:
-                    attr_list.update(self.get_legitimate_attibutes(base))
+            el_ns, el_type = schema.namespace, name
+
+        attr_list = set(self.get_type_attributes(el_ns, el_type))
         attr_list.update(['default', 'fixed', 'form', 'id', 'name', 'ref', 'type', 'use'])
-        return attr_list
+        return frozenset([symbols.intern(attr) for attr in attr_list])
+
+    """Returns the attributes declared on a complexType and on every type it extends or
+    restricts, following the chain across namespaces. Only called while the context's lock
+    is held by get_legitimate_attributes, so the guard entry is never seen by another analysis"""
+    def get_type_attributes(self, namespace, type_name):
+        schemas = self.context.schemas
+        type_attribute_lookup = self.context.lookups['type_attribute_lookup']
+        key = (namespace, type_name)
+        profile_lookup('type_attribute_lookup', key in type_attribute_lookup)
+        if key in type_attribute_lookup:
+            return type_attribute_lookup[key]
+        type_attribute_lookup[key] = frozenset()#guards against circular derivations
+        if namespace not in schemas:
+            return type_attribute_lookup[key]
+
+        schema = schemas[namespace]
+        complex_type = schema.index.get_complex_type(type_name)
+        attr_list = set(complex_type['attributes'])
+        attr_list.update(complex_type['attribute_refs'])
+        attr_list.update(complex_type['attribute_groups'])
+        #If a given type extends or restricts another, it inherits the attributes of that base
+        for bases in (complex_type['extensions'], complex_type['restrictions']):
+            for base in bases:
+                attr_list.update(self.get_type_attributes(*schema.resolve_qname(base)))
+        type_attribute_lookup[key] = frozenset(attr_list)
+        return type_attribute_lookup[key]
         
     def set_schema(self, namespace):
-        global g_schemas
+        schemas = self.context.schemas
         if namespace in self.schemas:
             return self.schemas[namespace]
-        elif namespace in self.stix.tree.getroot().nsmap:
-            namespace = self.stix.tree.getroot().nsmap[namespace]
-        g_schemas[namespace].is_used = 1;
-        self.schemas.update({namespace : g_schemas[namespace]})
-        return g_schemas[namespace]
+        elif namespace in self.stix.nsmap:
+            namespace = self.stix.nsmap[namespace]
+        if namespace not in schemas:
+            raise KeyError("no schema is loaded for " + str(namespace))
+        self.schemas.update({namespace : schemas[namespace]})
+        return schemas[namespace]
     
     def update_nsmap(self, schema):
-        global g_schemas
+        schemas = self.context.schemas
         for ns in schema.nsmap: #For any namespaces referred to in the schema, find them and add
-            if ns in g_schemas:
-                self.schemas[ns] = g_schemas[ns]
-                g_schemas[ns].is_used = 1
+            if ns in schemas:
+                self.schemas[ns] = schemas[ns]
         return schema.nsmap
     
     def get_element_type(self, schema, nsmap, name):
-        return schema.tree.getroot().xpath("//xsd:element[@name=$n]/@type", namespaces=nsmap, n = name)
+        return list(schema.index.element_types.get(name, []))
     
     def get_children_names(self, schema, nsmap, etype):
-        names = set()
-        names.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:element/@name",
-                                    namespaces={"xsd" : "http://www.w3.org/2001/XMLSchema"}, n = etype))
-        names.update(schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:element/@ref",
-                                    namespaces = nsmap, n = etype))
-        return names
+        complex_type = schema.index.get_complex_type(etype)
+        return complex_type['elements'] | complex_type['element_refs']
 
     def get_base(self, schema, nsmap, etype):
         #If a given element extends another, get the valid subelement of the element being extended
-        return schema.tree.getroot().xpath("//xsd:complexType[@name=$n]//xsd:extension/@base",
-                                namespaces=nsmap, n = etype)
+        return list(schema.index.get_complex_type(etype)['extensions'])
     
-    def set_extended_children(self, element_name, schema, nsmap, el_type):
+    def set_extended_children(self, legit_children, schema, nsmap, el_type):
         extension = self.get_base(schema, nsmap, el_type)
         if not len(extension):
             return
@@ -422,148 +1402,964 @@ class Analytic:
              return
         if b_ns in nsmap:
             b_ns = nsmap[b_ns]
+        if b_ns not in self.context.schemas:
+            return#e.g. a built-in XML Schema type under a prefix other than xs
         schema = self.set_schema(b_ns)
         nsmap = self.update_nsmap(schema)
         children = self.get_children_names(schema, nsmap, el_type)
         for child in children:
             c_ns_and_name = '{' + b_ns + '}' + child
-            g_child_lookup[element_name].update([c_ns_and_name])
+            legit_children.add(self.context.symbols.intern(c_ns_and_name))
     
     def get_ref_element(self, ref_string):
         namespace = get_namespace(ref_string)
         name = trim_namespace(ref_string)
         schema = self.set_schema(namespace)
         nsmap = self.update_nsmap(schema)
-        return schema.tree.getroot().xpath("//xsd:element[@name=$n]", namespaces = nsmap, n = name).pop()
+        return schema.get_element_decl(name)
+    
+"""Precomputed lookup tables for a single XSD so that element, complexType and
+total lookups are dictionary hits instead of descendant-axis XPath scans"""
+class SchemaIndex:
+    EMPTY_TYPE = {
+                  'elements' : frozenset(),
+                  'element_refs' : frozenset(),
+                  'attributes' : frozenset(),
+                  'attribute_refs' : frozenset(),
+                  'attribute_groups' : frozenset(),
+                  'extensions' : (),
+                  'restrictions' : ()
+                  }
+
+    def __init__(self, root=None, cached=None):
+        self.element_types = {}#element name -> list of declared types, in document order
+        self.element_decls = {}#element name -> last element declaration with that name
+        self.complex_types = {}#complexType name -> declared elements, refs, attributes and bases
+        self.element_count = 0
+        self.attribute_count = 0
+        if cached is not None:
+            self.element_types = cached['element_types']
+            self.complex_types = cached['complex_types']
+            self.element_count = cached['element_count']
+            self.attribute_count = cached['attribute_count']
+            return
+        self.index_element_decls(root)
+
+        for element in root.iter(XSD_NS + 'element'):
+            name = element.get('name')
+            if name is not None and element.get('type') is not None:
+                self.element_types.setdefault(name, []).append(element.get('type'))
+
+        for complex_type in root.iter(XSD_NS + 'complexType'):
+            name = complex_type.get('name')
+            if name is None:
+                continue
+            self.index_complex_type(name, complex_type)
+
+        #Totals count every element/attribute declaration nested anywhere inside a complexType
+        for element in root.iter(XSD_NS + 'element'):
+            if self.in_complex_type(element):
+                self.element_count += ('name' in element.attrib) + ('ref' in element.attrib)
+        for attribute in root.iter(XSD_NS + 'attribute'):
+            if self.in_complex_type(attribute):
+                self.attribute_count += ('name' in attribute.attrib) + ('ref' in attribute.attrib)
+
+    """Records the last declaration of each element name, which (unlike the rest of the
+    index) holds schema nodes and so is not kept in the compiled schema cache"""
+    def index_element_decls(self, root):
+        for element in root.iter(XSD_NS + 'element'):
+            name = element.get('name')
+            if name is not None:
+                self.element_decls[name] = element
+
+    """Returns the picklable part of the index for the compiled schema cache"""
+    def to_cache(self):
+        return {
+                'element_types' : self.element_types,
+                'complex_types' : self.complex_types,
+                'element_count' : self.element_count,
+                'attribute_count' : self.attribute_count
+                }
+
+    """Records the declarations found beneath a named complexType"""
+    def index_complex_type(self, name, complex_type):
+        if name not in self.complex_types:
+            self.complex_types[name] = {
+                                        'elements' : set(),
+                                        'element_refs' : set(),
+                                        'attributes' : set(),
+                                        'attribute_refs' : set(),
+                                        'attribute_groups' : set(),
+                                        'extensions' : [],
+                                        'restrictions' : []
+                                        }
+        entry = self.complex_types[name]
+        for desc in complex_type.iterdescendants():
+            if desc.tag == XSD_NS + 'element':
+                if 'name' in desc.attrib:
+                    entry['elements'].add(desc.get('name'))
+                if 'ref' in desc.attrib:
+                    entry['element_refs'].add(desc.get('ref'))
+            elif desc.tag == XSD_NS + 'attribute':
+                if 'name' in desc.attrib:
+                    entry['attributes'].add(desc.get('name'))
+                if 'ref' in desc.attrib:
+                    entry['attribute_refs'].add(desc.get('ref'))
+            elif desc.tag == XSD_NS + 'attributeGroup' and 'ref' in desc.attrib:
+                entry['attribute_groups'].add(desc.get('ref'))
+            elif desc.tag == XSD_NS + 'extension' and 'base' in desc.attrib:
+                entry['extensions'].append(desc.get('base'))
+            elif desc.tag == XSD_NS + 'restriction' and 'base' in desc.attrib:
+                entry['restrictions'].append(desc.get('base'))
+
+    """Returns the indexed declarations of a complexType, or an empty entry if it is not declared"""
+    def get_complex_type(self, name):
+        return self.complex_types.get(name, self.EMPTY_TYPE)
+
+    """Returns true if the given schema node sits anywhere inside a complexType"""
+    def in_complex_type(self, node):
+        for ancestor in node.iterancestors(XSD_NS + 'complexType'):
+            return True
+        return False
     
 class Schema:
-    def __init__(self, sfile):
-        self.is_used = 0
+    def __init__(self, sfile=None, cached=None):
+        if cached is not None:
+            #Restored from the compiled schema cache, the XSD is only parsed again if its nodes are needed
+            self.filename = cached['filename']
+            self.namespace = cached['namespace']
+            self.nsmap = cached['nsmap']
+            self.index = SchemaIndex(cached=cached['index'])
+            self.tree = None
+            self.root = None
+            return
+        self.filename = sfile.name
         self.tree = etree.parse(sfile)
         self.root = self.tree.getroot()
         self.namespace = self.root.attrib['targetNamespace']
         logging.info('Generated schema etree from' + sfile.name)
         self.nsmap = self.root.nsmap
         self.nsmap.update({"xsd" : "http://www.w3.org/2001/XMLSchema"})
+        self.index = SchemaIndex(self.root)
+
+    """Returns the last declaration of the named element, parsing the XSD if it came from the cache"""
+    def get_element_decl(self, name):
+        if self.root is None:
+            self.tree = etree.parse(self.filename)
+            self.root = self.tree.getroot()
+            self.index.index_element_decls(self.root)
+        return self.index.element_decls[name]
+
+    """Splits a prefixed name used within this schema into its namespace and local name"""
+    def resolve_qname(self, qname):
+        if ':' in qname:
+            prefix, local = qname.split(':', 1)
+            return self.nsmap.get(prefix, prefix), local
+        return self.nsmap.get(None, self.namespace), qname
+
+    """Returns the picklable form of this schema for the compiled schema cache"""
+    def to_cache(self):
+        return {
+                'filename' : self.filename,
+                'namespace' : self.namespace,
+                'nsmap' : self.nsmap,
+                'index' : self.index.to_cache()
+                }
+
+"""The schemas by target namespace. Every schema is listed in a manifest of its file and totals, but
+one restored from the compiled schema cache is only unpickled the first time it is looked up, so an
+input only pays for its own namespaces and those the schemas it touches refer to"""
+class SchemaRegistry:
+    def __init__(self):
+        self.manifest = {}#namespace -> filename, element_count, attribute_count (and offset, length in the cache)
+        self.schemas = {}#namespace -> Schema, once loaded
+        self.cache_path = None
+        self.cache_base = 0
+        self.lock = threading.Lock()#schemas are looked up by analyses running in several threads
+
+    def __contains__(self, namespace):
+        return namespace in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __iter__(self):
+        return iter(self.manifest)
+
+    def __getitem__(self, namespace):
+        if namespace not in self.schemas:
+            if namespace not in self.manifest:
+                raise KeyError(namespace)
+            with self.lock:
+                if namespace not in self.schemas:
+                    with profile_phase('lazy_schema_load'):
+                        self.schemas[namespace] = self.load(namespace)
+        return self.schemas[namespace]
+
+    """Adds a schema that has already been loaded"""
+    def __setitem__(self, namespace, schema):
+        self.schemas[namespace] = schema
+        self.manifest[namespace] = {
+                                    'filename' : schema.filename,
+                                    'element_count' : schema.index.element_count,
+                                    'attribute_count' : schema.index.attribute_count
+                                    }
+
+    def get(self, namespace, default=None):
+        if namespace in self.manifest:
+            return self[namespace]
+        return default
+
+    """Iterates over the schemas that have been loaded so far, which are the only ones that can be in use"""
+    def iter_loaded(self):
+        return self.schemas.itervalues()
+
+    """Sums a total from the manifest, without loading any schema"""
+    def get_total(self, total):
+        return sum([entry[total] for entry in self.manifest.itervalues()])
+
+    """Lists the schemas in the compiled schema cache at cache_path, whose entries start at cache_base"""
+    def set_cache(self, cache_path, cache_base, manifest):
+        self.cache_path = cache_path
+        self.cache_base = cache_base
+        self.manifest.update(manifest)
+
+    def load(self, namespace):
+        entry = self.manifest[namespace]
+        try:
+            with open(self.cache_path, 'rb') as cfile:
+                cfile.seek(self.cache_base + entry['offset'])
+                schema = Schema(cached=cPickle.loads(cfile.read(entry['length'])))
+        except Exception as e:
+            #The cache may have been truncated or replaced since it was listed, the XSD itself still serves
+            logging.warning("Schema " + entry['filename'] + " could not be loaded from " + self.cache_path + ", parsing it: " + str(e))
+            with open(entry['filename'], 'r') as xsd:
+                return Schema(xsd)
+        logging.info("Loaded schema " + entry['filename'] + " from " + self.cache_path)
+        return schema
             
+"""The loaded schemas with the symbols and lookups worked out from them, everything an Analytic needs
+besides its input. A context is set up once, by load_context, and is not changed afterwards apart from
+its lookups filling in, so any number of analyses can share one, including analyses running at the same
+time in different threads. Lookup entries are computed under the context's lock and only stored once
+complete, which keeps hits lock free and means no analysis ever sees another's half-built entry"""
+class SchemaContext:
+    def __init__(self):
+        self.schemas = SchemaRegistry()#the schemas by namespace
+        self.symbols = SymbolTable()#the names used in the lookups
+        self.fingerprint = None#content hash of the XSDs, see get_schema_fingerprint
+        self.coverage_map = None#CoverageMap of the schemas, once coverage is asked for
+        self.lock = threading.RLock()#the lookups fill each other in while one is being computed
+        self.lookups = {
+                        'child_lookup' : {},#element or type symbol -> symbols of the elements that may appear directly beneath it
+                        'closure_lookup' : {},#element or type symbol -> symbols of every element that may appear beneath it
+                        'possible_children_lookup' : {},#(tag, xsi:type) -> symbols of the possible recursive children of such a node
+                        'attribute_lookup' : {},#element or type symbol -> symbols of its possible attributes, including inherited ones
+                        'type_attribute_lookup' : {},#(namespace, complexType name) -> attributes declared on it or its bases
+                        'possible_attributes_lookup' : {},#(tag, xsi:type) -> symbols of the possible attributes of such a node
+                        'node_lookup' : {}#(tag, xsi:type) -> name and possible attribute, direct and recursive child counts of such a node
+                        }
+
+    """Returns the entry for key in the named lookup, computing it with compute(key) the first time"""
+    def get_lookup(self, lookup, key, compute):
+        entries = self.lookups[lookup]
+        profile_lookup(lookup, key in entries)
+        if key not in entries:
+            with self.lock:
+                if key not in entries:
+                    entries[key] = compute(key)
+        return entries[key]
+
+    """Returns the CoverageMap of the schemas, which loads every one of them the first time"""
+    def get_coverage_map(self):
+        if self.coverage_map is None:
+            with self.lock:
+                if self.coverage_map is None:
+                    self.coverage_map = CoverageMap(self.schemas)
+        return self.coverage_map
+
+    """Loads every schema and fills the lookups in for each element and complexType they declare, and
+    for nodes of each declared element without an xsi:type. Lookups are otherwise filled in as files
+    need them, so this is for worker processes about to be forked: they then share the lookups
+    copy-on-write rather than each working them out again"""
+    def warm(self):
+        ifile = StringIO.StringIO()
+        ifile.name = WARM_NAME
+        analytic = Analytic(StixStream(ifile), self)
+        for namespace in sorted(self.schemas):
+            index = self.schemas[namespace].index
+            for name in sorted(index.element_types):
+                self.get_lookup('node_lookup', ('{' + namespace + '}' + name, None), analytic.get_node_counts)
+            for name in sorted(index.complex_types):
+                symbol = self.symbols.intern('{' + namespace + '}' + name)
+                analytic.get_legitimate_children(symbol)
+                analytic.get_legitimate_attributes(symbol)
+                analytic.get_possible_descendants(symbol)
+        logging.info("Worked out the lookups of " + str(len(self.lookups['child_lookup'])) + " schema elements and types")
+
+    """Loads the given XSD files, or when the compiled schema cache at cache_path was built from
+    exactly the same XSD contents, lists the schemas in it to be loaded as they are needed"""
+    def load_schemas(self, xsd_files, cache_path=None):
+        fingerprint = get_schema_fingerprint(xsd_files)
+        self.fingerprint = fingerprint
+        if cache_path and self.load_schema_cache(cache_path, fingerprint):
+            return
+        for sfile in xsd_files:
+            self.add_schema(sfile)
+        if cache_path:
+            self.save_schema_cache(cache_path, fingerprint)
+
+    """Lists the schemas in the compiled schema cache, returns false if it is missing or stale.
+    The cache starts with the fingerprint and manifest, followed by each schema pickled on its own"""
+    def load_schema_cache(self, cache_path, fingerprint):
+        try:
+            with open(cache_path, 'rb') as cfile:
+                header = cPickle.load(cfile)
+                cache_base = cfile.tell()
+        except Exception as e:
+            logging.info("Schema cache " + cache_path + " could not be read: " + str(e))
+            return False
+        if not isinstance(header, dict) or header.get('fingerprint') != fingerprint:
+            logging.info("Schema cache " + cache_path + " is stale, rebuilding")
+            return False
+        self.schemas.set_cache(cache_path, cache_base, header['manifest'])
+        logging.info("Listed " + str(len(self.schemas)) + " schemas from " + cache_path)
+        return True
+
+    """Writes the schemas to the compiled schema cache, replacing it atomically"""
+    def save_schema_cache(self, cache_path, fingerprint):
+        manifest = {}
+        entries = []
+        offset = 0
+        for schema in self.schemas.iter_loaded():
+            entry = cPickle.dumps(schema.to_cache(), cPickle.HIGHEST_PROTOCOL)
+            manifest[schema.namespace] = dict(self.schemas.manifest[schema.namespace], offset=offset, length=len(entry))
+            entries.append(entry)
+            offset += len(entry)
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'#processes saving at once each write their own
+        try:
+            with open(tmp_path, 'wb') as cfile:
+                cPickle.dump({'fingerprint' : fingerprint, 'manifest' : manifest}, cfile, cPickle.HIGHEST_PROTOCOL)
+                for entry in entries:
+                    cfile.write(entry)
+            os.rename(tmp_path, cache_path)
+            logging.info("Saved compiled schemas to " + cache_path)
+        except (IOError, OSError) as e:
+            logging.warning("Schema cache " + cache_path + " could not be written: " + str(e))
+
+    def add_schema(self, xsd):
+        schema_to_add = Schema(xsd)
+        namespace = schema_to_add.namespace
+        if namespace not in self.schemas:
+            self.schemas[namespace] = schema_to_add
+            logging.info('Added' + xsd.name + 'to schema locations')
+        else:
+            logging.debug(xsd.name + 'is a duplicate of another XSD using namespace: ' + namespace)
+
+"""Writes the report for each Analytic to an output stream as soon as it is finished. The schema
+totals come from context, and the schemas counted as used are the namespaces in used_schemas"""
+class ReportEmitter:
+    def __init__(self, stream, include_leaves=False, context=None, used_schemas=()):
+        self.stream = stream
+        self.include_leaves = include_leaves
+        self.context = context
+        self.used_schemas = used_schemas
+
+    """Writes anything that comes before the first file"""
+    def begin(self):
+        pass
+
+    """Writes the report for one finished file"""
+    def emit(self, analytic):
+        pass
+
+    """Writes anything that is only known once every file has been analyzed"""
+    def end(self):
+        pass
+
+    """Writes the statistics accumulated over a corpus of files, after the last file"""
+    def emit_corpus(self, corpus, path):
+        pass
+
+    """Writes the coverage of a corpus, compared with the coverage of another if given"""
+    def emit_coverage(self, coverage, path, other=None, other_path=None):
+        pass
+
+    """Returns the coverage counts and name lists, plus the names only one of two corpora used"""
+    def get_coverage_summary(self, coverage, other=None):
+        summary = {'files' : coverage.files}
+        for kind in coverage.KINDS:
+            summary[kind] = {
+                             'possible' : len(coverage.map.names[kind]),
+                             'used' : coverage.count(coverage.used[kind]),
+                             'in_every_file' : coverage.map.get_names(coverage.common[kind] or 0, kind),
+                             'never_used' : coverage.map.get_names(coverage.get_unused(kind), kind)
+                             }
+            if other is not None:
+                summary[kind]['only_here'] = coverage.map.get_names(coverage.used[kind] & ~other.used[kind], kind)
+                summary[kind]['only_there'] = coverage.map.get_names(other.used[kind] & ~coverage.used[kind], kind)
+                summary[kind]['never_used_by_either'] = coverage.map.get_names(coverage.get_unused(kind) & other.get_unused(kind), kind)
+        return summary
+
+    """Writes part of the report straight away"""
+    def write(self, to_write):
+        self.stream.write(to_write)
+        self.stream.flush()
+
+    """Returns the overall totals of the loaded schemas"""
+    def get_schema_summary(self):
+        schemas = self.context.schemas
+        return {
+                'xsds_included' : len(schemas),
+                'xsds_used' : len(self.used_schemas),
+                'unique_elements' : get_total_possible_elements(schemas),
+                'unique_attributes' : get_total_possible_attributes(schemas)
+                }
+
+"""The human readable summary report"""
+class TextEmitter(ReportEmitter):
+    """Prints the schema totals that open the 'pretty' report"""
+    def begin(self):
+        summary = self.get_schema_summary()
+        to_string  = "XSDs included:         "  + str(summary['xsds_included']) + "\n"
+        to_string += "Unique XSD Elements:   " + str(summary['unique_elements']) + "\n"
+        to_string += "Unique XSD Attributes: " + str(summary['unique_attributes']) + "\n" 
+        self.write(to_string)
+
+    """Prints the number of schemas used, which is only known once every file has been analyzed"""
+    def end(self):
+        self.write("\nXSDs used:             "  + str(self.get_schema_summary()['xsds_used']) + "\n")
+    
+    """Prints a 'pretty' version of Stix Analytix for a stixinput file"""
+    def emit(self, analytic):
+        include_leaves = self.include_leaves
+        to_string = "\n---------------" + analytic.stats.filename + "---------------\n"
+        to_string += "File:"
+        to_string += "\n\t# Schemas:                " + str(analytic.stats.schema_count)
+        to_string += "\n\t# Elements:               " + str(analytic.stats.el_count)
+        to_string += "\n\tElement %:                " + str(analytic.stats.child_percent)
+        to_string += "\n\tAttributes:               " + str(analytic.stats.attr_present)
+        to_string += "\n\tAttribute %:              " + str(analytic.stats.attr_percent)
+        to_string += "\n\tOverall %:                " + str(analytic.stats.overall_percent)
+        for ekey in analytic.stats.type_stats.iterkeys():
+            if include_leaves == False and analytic.stats.type_stats[ekey]['num_direct_child_pres'] == 0 and analytic.stats.type_stats[ekey]['num_attr_pres'] == 0:
+                continue
+            else:
+                type_stats = analytic.stats.type_stats[ekey]
+                to_string += "\n\t" + ekey + ":"
+                to_string += "\n\t\tCount:                " + str(type_stats['count'])
+                if 'sampled' in type_stats:
+                    to_string += "\n\t\tSampled:              " + str(type_stats['sampled'])
+                to_string += "\n\t\tDirect SubElements:   " + self.get_estimate(type_stats, 'num_direct_child_pres')
+                to_string += "\n\t\tRecur SubElements:    " + self.get_estimate(type_stats, 'num_recur_child_pres')
+                if analytic.stats.type_stats[ekey]['num_direct_child_pres'] > 0:
+                    to_string += "\n\t\t\tDirect Element %: " + self.get_estimate(type_stats, 'direct_child_ratio')
+                    to_string += "\n\t\t\tRecur Element %:  " + self.get_estimate(type_stats, 'recur_child_ratio')
+                    to_string += "\n\t\t\tAvg SubElement #: " + self.get_estimate(type_stats, 'child_avg')
+                    to_string += "\n\t\t\tMin SubElements:  " + str(analytic.stats.type_stats[ekey]['child_min']) 
+                    to_string += "\n\t\t\tMax SubElements:  " + str(analytic.stats.type_stats[ekey]['child_max']) 
+                to_string += "\n\t\tAttributes:           " + self.get_estimate(type_stats, 'num_attr_pres')
+                if analytic.stats.type_stats[ekey]['num_attr_pres'] > 0:
+                    to_string += "\n\t\t\tAttribute %:      " + self.get_estimate(type_stats, 'attr_ratio')
+                    to_string += "\n\t\t\tAvg Attribute #:  " + self.get_estimate(type_stats, 'attr_avg')
+                    to_string += "\n\t\t\tMin Attributes:   " + str(analytic.stats.type_stats[ekey]['attr_min']) 
+                    to_string += "\n\t\t\tMax Attributes:   " + str(analytic.stats.type_stats[ekey]['attr_max'])
+        to_string += "\n"
+        self.write(to_string)
+
+    """Returns a type statistic, followed by its confidence interval when it was estimated by --sample"""
+    def get_estimate(self, type_stats, key):
+        if key + '_ci' in type_stats:
+            if type_stats[key + '_ci'] is None:
+                return str(type_stats[key]) + " +/- unknown"
+            return str(type_stats[key]) + " +/- " + str(type_stats[key + '_ci'])
+        return str(type_stats[key])
+
+    """Prints the per type statistics of a whole corpus"""
+    def emit_corpus(self, corpus, path):
+        to_string = "\n---------------Corpus: " + path + "---------------\n"
+        to_string += "Corpus:"
+        to_string += "\n\t# Files:                  " + str(corpus.files)
+        to_string += "\n\t# Elements:               " + str(corpus.el_count)
+        to_string += "\n\tAttributes:               " + str(corpus.attr_present)
+        for el_type in sorted(corpus.types):
+            totals = corpus.types[el_type]
+            if self.include_leaves == False and totals.sums['direct_child'] == 0 and totals.sums['attr'] == 0:
+                continue
+            to_string += "\n\t" + el_type + ":"
+            to_string += "\n\t\tCount:                " + str(totals.count)
+            to_string += "\n\t\tAvg SubElement #:     " + str(totals.mean('direct_child'))
+            to_string += "\n\t\tAvg Recur Element #:  " + str(totals.mean('recur_child'))
+            to_string += "\n\t\tAvg Attribute #:      " + str(totals.mean('attr'))
+            to_string += "\n\t\tDirect Element %:     " + str(totals.mean('direct_child_ratio'))
+            to_string += "\n\t\tRecur Element %:      " + str(totals.mean('recur_child_ratio'))
+            to_string += "\n\t\tAttribute %:          " + str(totals.mean('attr_ratio'))
+        to_string += "\n"
+        self.write(to_string)
+
+    """Prints how much of the schemas a corpus covers and, compared with another corpus,
+    the names that only one of them used"""
+    def emit_coverage(self, coverage, path, other=None, other_path=None):
+        summary = self.get_coverage_summary(coverage, other)
+        to_string = "\n---------------Coverage: " + path + "---------------\n"
+        to_string += "Coverage:"
+        to_string += "\n\t# Files:                  " + str(summary['files'])
+        for kind in coverage.KINDS:
+            totals = summary[kind]
+            to_string += "\n\t" + kind.capitalize() + ":"
+            to_string += "\n\t\tUsed:                 " + str(totals['used']) + " of " + str(totals['possible'])
+            to_string += "\n\t\tIn every file:        " + str(len(totals['in_every_file']))
+            to_string += "\n\t\tNever used:           " + str(len(totals['never_used']))
+            if other is not None:
+                to_string += "\n\t\tNever used by either: " + str(len(totals['never_used_by_either']))
+                to_string += "\n\t\tOnly used here:       " + str(len(totals['only_here']))
+                to_string += "".join(["\n\t\t\t" + name for name in totals['only_here']])
+                to_string += "\n\t\tOnly used in " + other_path + ": " + str(len(totals['only_there']))
+                to_string += "".join(["\n\t\t\t" + name for name in totals['only_there']])
+        to_string += "\n"
+        self.write(to_string)
+
+"""Simply prints the dict containing the raw info on each STIX file, for --debug"""
+class DebugEmitter(ReportEmitter):
+    def emit(self, analytic):
+        self.write("\n\n---------------" + analytic.stats.filename + "---------------\n")
+        json.dump(analytic.info, self.stream, indent=2)
+        self.stream.flush()
+
+    def end(self):
+        self.write("\n")
+
+"""One JSON object per line for each file, followed by a line with the schema totals"""
+class JsonLinesEmitter(ReportEmitter):
+    def emit(self, analytic):
+        stats = analytic.stats
+        record = {
+                  'record' : 'file',
+                  'file' : stats.filename,
+                  'schema_count' : stats.schema_count,
+                  'el_count' : stats.el_count,
+                  'attr_present' : stats.attr_present,
+                  'child_percent' : stats.child_percent,
+                  'attr_percent' : stats.attr_percent,
+                  'overall_percent' : stats.overall_percent,
+                  'type_stats' : stats.type_stats
+                  }
+        if analytic.info:
+            record['info'] = analytic.info
+        self.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def emit_corpus(self, corpus, path):
+        record = corpus.to_dict()
+        record['record'] = 'corpus'
+        record['corpus'] = path
+        self.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def emit_coverage(self, coverage, path, other=None, other_path=None):
+        record = self.get_coverage_summary(coverage, other)
+        record['record'] = 'coverage'
+        record['coverage'] = path
+        if other is not None:
+            record['compared_with'] = other_path
+        self.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def end(self):
+        summary = self.get_schema_summary()
+        summary['record'] = 'summary'
+        self.write(json.dumps(summary, sort_keys=True) + "\n")
+
+"""One CSV row per element type per file"""
+class CsvEmitter(ReportEmitter):
+    FIELDS = ['count', 'num_attr_pres', 'num_direct_child_pres', 'num_recur_child_pres',
+              'attr_ratio', 'direct_child_ratio', 'recur_child_ratio',
+              'attr_min', 'attr_max', 'attr_avg', 'child_min', 'child_max', 'child_avg']
+
+    def __init__(self, stream, include_leaves=False, context=None, used_schemas=()):
+        ReportEmitter.__init__(self, stream, include_leaves, context, used_schemas)
+        self.writer = csv.writer(self.stream)#--serve emits without a header row, so the writer cannot wait for begin
+
+    def begin(self):
+        self.writer.writerow(['file', 'type'] + self.FIELDS)
+
+    def emit(self, analytic):
+        for el_type in sorted(analytic.stats.type_stats):
+            type_stats = analytic.stats.type_stats[el_type]
+            self.writer.writerow([analytic.stats.filename, el_type] + [type_stats[field] for field in self.FIELDS])
+        self.stream.flush()
+
+    """Writes corpus rows in the same columns, computed from the corpus totals"""
+    def emit_corpus(self, corpus, path):
+        for el_type in sorted(corpus.types):
+            totals = corpus.types[el_type]
+            self.writer.writerow([path, el_type, totals.count, totals.sums['attr'], totals.sums['direct_child'], totals.sums['recur_child'],
+                                  totals.mean('attr_ratio'), totals.mean('direct_child_ratio'), totals.mean('recur_child_ratio'),
+                                  totals.mins['attr'], totals.maxes['attr'], totals.mean('attr'),
+                                  totals.mins['direct_child'], totals.maxes['direct_child'], totals.mean('direct_child')])
+        self.stream.flush()
+
+EMITTERS = {
+            'text' : TextEmitter,
+            'jsonl' : JsonLinesEmitter,
+            'csv' : CsvEmitter
+            }
+
+"""Reports on STIX documents sent over a Unix socket, see StixServer"""
+class StixRequestHandler(SocketServer.StreamRequestHandler):
+    timeout = SERVE_TIMEOUT#a client that stops sending cannot hold a worker thread for longer
+
+    def handle(self):
+        try:
+            document = self.rfile.read(SERVE_MAX_BYTES + 1)
+        except socket.timeout:
+            logging.warning("Gave up on a submission not finished within " + str(self.timeout) + " seconds")
+            self.wfile.write("ERROR the document was not sent within " + str(self.timeout) + " seconds\n")
+            return
+        if not document:
+            return#nothing was sent, e.g. by a server checking whether this one is running
+        if len(document) > SERVE_MAX_BYTES:
+            logging.warning("Turned away a submission of over " + str(SERVE_MAX_BYTES) + " bytes")
+            self.wfile.write("ERROR the submitted document is larger than " + str(SERVE_MAX_BYTES) + " bytes\n")
+            self.server.drain(self.connection)
+            return
+        try:
+            analytic = self.server.analyze(document)
+        except Exception as e:
+            logging.exception("Failed to analyze submitted document")
+            analytic = None
+        if analytic is None:
+            self.wfile.write("ERROR the submitted document could not be analyzed\n")
+            return
+        self.server.emitter_class(self.wfile, self.server.include_leaves).emit(analytic)
+
+"""Serves reports over a Unix socket, keeping the schemas and lookup caches warm between documents.
+A client sends one document, shuts down its side of the connection and reads back the report.
+Connections are handled by a fixed number of worker threads, and any arriving while queue_size
+others are already waiting are answered BUSY straight away rather than piling up. Turned away
+connections are in turn queued for SERVE_DRAINERS threads, so that their clients can finish sending
+and read the answer; once queue_size of those are waiting too, the rest are answered and closed"""
+class StixServer(SocketServer.UnixStreamServer):
+    def __init__(self, path, analyze, emitter_class, include_leaves=False, workers=1, queue_size=SERVE_QUEUE):
+        SocketServer.UnixStreamServer.__init__(self, path, StixRequestHandler)
+        self.analyze = analyze
+        self.emitter_class = emitter_class
+        self.include_leaves = include_leaves
+        self.waiting = Queue.Queue(queue_size)
+        self.turned_away = Queue.Queue(queue_size)
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_waiting)
+            worker.daemon = True
+            worker.start()
+        for i in range(SERVE_DRAINERS):
+            drainer = threading.Thread(target=self.process_turned_away)
+            drainer.daemon = True
+            drainer.start()
+
+    """Queues an accepted connection for the workers, or turns it away if the queue is full"""
+    def process_request(self, request, client_address):
+        try:
+            self.waiting.put_nowait((request, client_address))
+            return
+        except Queue.Full:
+            logging.warning("Turned away a submission, " + str(self.waiting.qsize()) + " already waiting")
+        try:
+            self.turned_away.put_nowait(request)
+        except Queue.Full:
+            self.refuse(request)
+
+    def process_turned_away(self):
+        while True:
+            self.turn_away(self.turned_away.get())
+
+    """Answers BUSY and reads the rest of the document, so that the client can finish sending it
+    and then read the answer rather than having its connection reset"""
+    def turn_away(self, request):
+        try:
+            request.sendall("BUSY\n")
+            request.shutdown(socket.SHUT_WR)
+            self.drain(request)
+        except socket.error:
+            pass
+        finally:
+            request.close()
+
+    """Answers BUSY and closes at once, without waiting for the client to finish sending"""
+    def refuse(self, request):
+        try:
+            request.setblocking(0)#never hold up the accepting thread
+            request.send("BUSY\n")
+        except socket.error:
+            pass
+        finally:
+            request.close()
+
+    """Reads and discards whatever the client still sends, for at most SERVE_TIMEOUT seconds"""
+    def drain(self, request):
+        deadline = time.time() + SERVE_TIMEOUT
+        try:
+            while time.time() < deadline:
+                request.settimeout(max(deadline - time.time(), 0.01))
+                if not request.recv(1 << 16):
+                    break
+        except socket.error:
+            pass
+
+    def process_waiting(self):
+        while True:
+            request, client_address = self.waiting.get()
+            try:
+                self.finish_request(request, client_address)
+            except socket.error as e:
+                logging.warning("Lost the client of a submission: " + str(e))
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
 class StixAnalytix:
     """__init__ converts the set of XML Schema files that define STIX into a set of e-trees 
     that we can compare against against stixinput STIX files"""
     def __init__(self):
-        self.analytics = []# list of Analytics instances
+        self.context = None
+        self.used_schemas = set()#namespaces of the schemas used by any file analyzed
+        self.pool = None
+        self.submissions = 0#documents analyzed by --serve, for trimming its result cache as it goes
+        self.submissions_lock = threading.Lock()
     
-    """Parses args and depending on that, process the information and generate analytics accordingly"""
+    """Parses args and depending on that, process the information and generate analytics accordingly.
+    Returns the exit status, 1 if any input was skipped or none could be analyzed"""
     def main(self, args):
-        global g_schemas
+        global g_profile
         
         if args.log:
             logging.basicConfig(filename="./StixAnalytix.log", filemode='w', level=logging.INFO)
         logging.debug("Args: %s", args)
+        if args.profile:
+            g_profile = Profile()
+            started = time.time()
         
-        #takes stixinput files and makes them into etrees
-        for filename in args.files:
-            self.analytics.append(Analytic(StixInput(filename)))
-        
-        #Across each file set up schema tree based off that file
-        for filename in os.listdir('xsds'):
-            sfile = open('xsds/' + filename, 'r')
-            self.add_schema(sfile)
-            sfile.close()
-        #if additional schema files are given, add them
+        #Across each file set up schema tree based off that file, plus any additional schema files given
+        xsd_files = [open('xsds/' + filename, 'r') for filename in os.listdir('xsds')]
         if args.xsd:
-            for sfile in args.xsd:
-                self.add_schema(sfile)
-        #For each input stix instance, run analytics
-        for instance in self.analytics:
-            instance.set_schemas(g_schemas)
-            instance.process_stix_tree()
-        
-        #If the debug flag is raised, use the debug printing method
-        if args.debug == True:
-            print self.to_string_debug()
-        else:
-            print self.to_string(args.includeleaves)
-            
-    def add_schema(self, xsd):
-        global g_schemas
-        schema_to_add = Schema(xsd)
-        namespace = schema_to_add.namespace
-        if namespace not in g_schemas:
-            g_schemas[namespace] = schema_to_add
-            logging.info('Added' + xsd.name + 'to schema locations')
-        else:
-            logging.debug(xsd.name + 'is a duplicate of another XSD using namespace: ' + namespace)
-    
-    """Simply prints the dict containing the raw info on the STIX file """
-    def to_string_debug(self):
-        if len(self.analytics) > 0:
-            to_string =""
-            for analytic in self.analytics:
-                to_string += "\n\n---------------" + analytic.stix.filename + "---------------\n"
-                to_string += json.dumps(analytic.info, indent=2)
-            return to_string
+            xsd_files.extend(args.xsd)
+        with profile_phase('load_schemas'):
+            self.load_schemas(xsd_files, None if args.nocache else args.cache)
+        for sfile in xsd_files:
+            sfile.close()
+        if args.jobs > 1:
+            #Worked out once here rather than in every worker process forked from this one
+            with profile_phase('warm_lookups'):
+                self.context.warm()
+
+        #Results of unchanged files are reused, except for --debug which needs the full per-node info
+        #and --sample whose estimates are not exact results
+        result_cache = None
+        if args.result_cache and not args.debug and not args.sample:
+            result_cache = ResultCache(args.result_cache, self.context.fingerprint,
+                                       args.result_cache_entries, args.result_cache_size * 1024 * 1024)
+
+        if args.serve:
+            self.serve(args, result_cache)
+            return
+
+        if args.output:
+            output = open(args.output, 'wb' if args.format == 'csv' else 'w')
         else:
-            return logging.ERROR("SA_full dict is empty--you may need to run process(filename)")
-    
-    """Prints a 'pretty' version of Stix Analytix for each stixinput file"""
-    def to_string(self, include_leaves):
-        global g_schemas
-        to_string  = "XSDs included:         "  + str(len(g_schemas)) + "\n"
-        to_string += "XSDs used:             "  + str(sum([schema.is_used for schema in g_schemas.itervalues()])) + "\n"
-        to_string += "Unique XSD Elements:   " + str(get_total_possible_elements()) + "\n"
-        to_string += "Unique XSD Attributes: " + str(get_total_possible_attributes()) + "\n" 
-        if len(self.analytics) > 0:
-            for analytic in self.analytics:
-                to_string += "\n---------------" + analytic.stix.filename + "---------------\n"
-                to_string += "File:"
-                to_string += "\n\t# Schemas:                " + str(analytic.stats.schema_count)
-                to_string += "\n\t# Elements:               " + str(analytic.stats.el_count)
-                to_string += "\n\tElement %:                " + str(analytic.stats.child_percent)
-                to_string += "\n\tAttributes:               " + str(analytic.stats.attr_present)
-                to_string += "\n\tAttribute %:              " + str(analytic.stats.attr_percent)
-                to_string += "\n\tOverall %:                " + str(analytic.stats.overall_percent)
-                for ekey in analytic.stats.type_stats.iterkeys():
-                    if include_leaves == False and analytic.stats.type_stats[ekey]['num_direct_child_pres'] == 0 and analytic.stats.type_stats[ekey]['num_attr_pres'] == 0:
-                        continue
-                    else:
-                        to_string += "\n\t" + ekey + ":"
-                        to_string += "\n\t\tCount:                " + str(analytic.stats.type_stats[ekey]['count'])
-                        to_string += "\n\t\tDirect SubElements:   " + str(analytic.stats.type_stats[ekey]['num_direct_child_pres'])
-                        to_string += "\n\t\tRecur SubElements:    " + str(analytic.stats.type_stats[ekey]['num_recur_child_pres'])
-                        if analytic.stats.type_stats[ekey]['num_direct_child_pres'] > 0:
-                            to_string += "\n\t\t\tDirect Element %: " + str(analytic.stats.type_stats[ekey]['direct_child_ratio'])
-                            to_string += "\n\t\t\tRecur Element %:  " + str(analytic.stats.type_stats[ekey]['recur_child_ratio'])
-                            to_string += "\n\t\t\tAvg SubElement #: " + str(analytic.stats.type_stats[ekey]['child_avg']) 
-                            to_string += "\n\t\t\tMin SubElements:  " + str(analytic.stats.type_stats[ekey]['child_min']) 
-                            to_string += "\n\t\t\tMax SubElements:  " + str(analytic.stats.type_stats[ekey]['child_max']) 
-                        to_string += "\n\t\tAttributes:           " +  str(analytic.stats.type_stats[ekey]['num_attr_pres'])
-                        if analytic.stats.type_stats[ekey]['num_attr_pres'] > 0:
-                            to_string += "\n\t\t\tAttribute %:      " + str(analytic.stats.type_stats[ekey]['attr_ratio'])
-                            to_string += "\n\t\t\tAvg Attribute #:  " + str(analytic.stats.type_stats[ekey]['attr_avg']) 
-                            to_string += "\n\t\t\tMin Attributes:   " + str(analytic.stats.type_stats[ekey]['attr_min']) 
-                            to_string += "\n\t\t\tMax Attributes:   " + str(analytic.stats.type_stats[ekey]['attr_max'])
-                to_string += "\n"
-            return to_string 
+            output = sys.stdout
+        #If the debug flag is raised, use the debug printing method
+        if args.debug == True and args.format == 'text':
+            emitter = DebugEmitter(output, context=self.context, used_schemas=self.used_schemas)
         else:
-            return logging.ERROR("SA_full dict (and therefore the summary dict) is empty--you may need to run process(filename)")
-    
+            emitter = EMITTERS[args.format](output, args.includeleaves, self.context, self.used_schemas)
 
-    
+        #Corpus statistics carry on from the saved totals of earlier runs, plus any others merged in
+        if args.corpus:
+            corpus = CorpusStats()
+            if os.path.exists(args.corpus):
+                corpus.load(args.corpus)
+            for path in args.merge or []:
+                corpus.load(path)
+        #Coverage likewise carries on from earlier runs, it is set up before any worker is forked
+        if args.coverage:
+            coverage_map = self.context.get_coverage_map()
+            coverage = CoverageStats(coverage_map)
+            if os.path.exists(args.coverage):
+                coverage.load(args.coverage)
 
-"""BEGIN CODE"""
-#get dictionary with all stix element's and their child elements
-stix_report = StixAnalytix()
+        emitter.begin()
+        #For each input stix file, run analytics (spread over worker processes if asked to) and
+        #report it as soon as it is done, so nothing is held on to between files. Archive members
+        #are streamed into the parser one at a time, unless they have to be buffered for the
+        #result cache or the worker processes
+        skipped = []#inputs that could not be read or analyzed, logged as they are skipped
+        analyzed = 0
+        sources = iter_sources(iter_input_files(args.files, args.recursive), args.jobs > 1 or result_cache is not None, skipped)
+        tasks = ((source, args.stream, args.debug, result_cache, args.sample, bool(args.coverage)) for source in sources)
+        job = profiled_file_job if args.profile else analyze_file_job
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+            analytics = pool.imap(job, tasks)
+        else:
+            analytics = (job(task) for task in tasks)
+        for analytic in analytics:
+            if analytic is None:
+                skipped.append(None)
+                continue
+            analyzed += 1
+            if args.profile:
+                g_profile.merge(analytic.profile)
+                g_profile.count('files')
+                g_profile.count('nodes', analytic.stats.el_count)
+            self.add_analytic(analytic)
+            with profile_phase('report'):
+                emitter.emit(analytic)
+            if args.corpus:
+                corpus.add_file_stats(analytic.stats)
+            if args.coverage:
+                coverage.add_coverage(analytic.coverage)
+        if args.jobs > 1:
+            pool.close()
+            pool.join()
+        if result_cache is not None:
+            result_cache.evict()
+        with profile_phase('report'):
+            if args.corpus:
+                corpus.save(args.corpus)
+                emitter.emit_corpus(corpus, args.corpus)
+            if args.coverage:
+                coverage.save(args.coverage)
+                if args.coverage_diff:
+                    other = CoverageStats(coverage_map)
+                    other.load(args.coverage_diff)
+                    emitter.emit_coverage(coverage, args.coverage, other, args.coverage_diff)
+                else:
+                    emitter.emit_coverage(coverage, args.coverage)
+            emitter.end()
+        if output is not sys.stdout:
+            output.close()
+        if args.profile:
+            self.save_profile(args.profile, time.time() - started, args.jobs)
+        if skipped:
+            logging.error(str(len(skipped)) + " inputs were skipped, " + str(analyzed) + " analyzed")
+            return 1
+        if analyzed == 0:
+            logging.error("No input files were found to analyze")
+            return 1
+        return 0
+
+    """Writes the --profile results as JSON, to stderr if the path is -"""
+    def save_profile(self, path, wall, jobs):
+        global g_profile
+        profile = g_profile.to_dict()
+        profile['wall'] = wall
+        profile['jobs'] = jobs
+        if path == '-':
+            json.dump(profile, sys.stderr, indent=1, sort_keys=True)
+            sys.stderr.write("\n")
+            return
+        with open(path, 'w') as pfile:
+            json.dump(profile, pfile, indent=1, sort_keys=True)
+            
+    """Serves reports on submitted documents at the --serve socket until interrupted. With --jobs the
+    documents are analyzed by worker processes forked from this one once its context has been warmed"""
+    def serve(self, args, result_cache):
+        if args.jobs > 1:
+            self.pool = multiprocessing.Pool(args.jobs, ignore_interrupt)
+        signal.signal(signal.SIGTERM, raise_interrupt)#set after forking, the workers are shut down by close
+        server = StixServer(args.serve, lambda document: self.analyze_submitted(document, args.stream, result_cache, args.sample),
+                            EMITTERS[args.format], args.includeleaves, max(args.jobs, 1), args.queue)
+        logging.info("Serving on " + args.serve)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.serve)
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            if result_cache is not None:
+                result_cache.evict()
 
-#sets up argument parsing
-parser = argparse.ArgumentParser(description='Run Analytics on a stix file or directory')
-parser.add_argument('files', type=file, nargs='+', help='A string representing a file or multiple files')
-parser.add_argument('-x', '--xsd', type=argparse.FileType('r'), help="optional flag for additional xsd files to integrate into the schema")
-parser.add_argument('-d','--debug', action='store_true', help='Displays the full version of Stix Analytix, as opposed to the normal summary')
-parser.add_argument('-l','--log', action='store_true', help='Flag for logging to stixanlaytix.log')
-parser.add_argument('-i','--includeleaves', action='store_true', help='Flag to toggle including Elements with no children')
+    """Analyzes one submitted document in a worker process, or on the calling server thread alongside
+    the other server threads, all sharing the one schema context"""
+    def analyze_submitted(self, document, stream=False, result_cache=None, sample=None):
+        task = (document, stream, result_cache, sample)
+        if self.pool is not None:
+            analytic = self.pool.apply(analyze_document_job, (task,))
+        else:
+            analytic = analyze_document_job(task)
+        if analytic is not None:
+            self.add_analytic(analytic)
+        if result_cache is not None:
+            with self.submissions_lock:
+                self.submissions += 1
+                evict = self.submissions % SERVE_EVICT_EVERY == 0
+            if evict:
+                result_cache.evict()#a server may never exit, so its cache is kept within limits as it runs
+        return analytic
 
-#runs the program
-stix_report.main(parser.parse_args())
+    """Records the schemas a finished Analytic used, for the report's XSDs used"""
+    def add_analytic(self, analytic):
+        self.used_schemas.update(analytic.schemas)
 
+    """Loads the schemas the command line runs against, see load_context"""
+    def load_schemas(self, xsd_files, cache_path=None):
+        global g_context
+        self.context = g_context = load_context(xsd_files, cache_path)
+    
+"""BEGIN CODE"""
+if __name__ == '__main__':
+    #get dictionary with all stix element's and their child elements
+    stix_report = StixAnalytix()
 
+    #sets up argument parsing
+    parser = argparse.ArgumentParser(description='Run Analytics on a stix file or directory')
+    parser.add_argument('files', nargs='*', help='Files, directories or glob patterns of stix files to analyze, archives (.zip, .tar, .tar.gz, .tar.bz2, .tar.xz) and compressed files (.gz, .bz2, .xz) are read member by member')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Flag to also analyze the files in subdirectories of any directory given')
+    parser.add_argument('-x', '--xsd', type=argparse.FileType('r'), action='append', help="optional flag for additional xsd files to integrate into the schema, may be repeated")
+    parser.add_argument('-c', '--cache', default=SCHEMA_CACHE, help='Location of the compiled schema cache (default: ' + SCHEMA_CACHE + ')')
+    parser.add_argument('--nocache', action='store_true', help='Flag to load the schemas without reading or writing the compiled schema cache')
+    parser.add_argument('--result-cache', help='Directory to cache each file\'s results in, keyed by its content, so unchanged files are not analyzed again (not used with --debug)')
+    parser.add_argument('--result-cache-entries', type=int, default=RESULT_CACHE_ENTRIES, help='Most results to keep in --result-cache (default: ' + str(RESULT_CACHE_ENTRIES) + ')')
+    parser.add_argument('--result-cache-size', type=int, default=RESULT_CACHE_BYTES / (1024 * 1024), help='Most megabytes of results to keep in --result-cache (default: ' + str(RESULT_CACHE_BYTES / (1024 * 1024)) + ')')
+    parser.add_argument('-d','--debug', action='store_true', help='Displays the full version of Stix Analytix, as opposed to the normal summary')
+    parser.add_argument('-f','--format', choices=sorted(EMITTERS), default='text', help='Report format (default: text), jsonl includes the full per-node info with --debug')
+    parser.add_argument('-o','--output', help='File to write the report to instead of stdout')
+    parser.add_argument('--corpus', help='File of corpus statistics to add this run\'s files to (created if missing) and report on')
+    parser.add_argument('-m','--merge', action='append', help='Saved corpus statistics (e.g. from another run or machine) to merge into --corpus, may be repeated')
+    parser.add_argument('--coverage', help='File of schema coverage (which possible elements and attributes are used) to add this run\'s files to (created if missing) and report on')
+    parser.add_argument('--coverage-diff', metavar='OTHER', help='Saved coverage (e.g. of another feed) to compare --coverage with')
+    parser.add_argument('-l','--log', action='store_true', help='Flag for logging to stixanlaytix.log')
+    parser.add_argument('-i','--includeleaves', action='store_true', help='Flag to toggle including Elements with no children')
+    parser.add_argument('-j','--jobs', type=int, default=1, help='Number of worker processes to analyze files with (default: 1)')
+    parser.add_argument('--sample', type=float, metavar='FRACTION', help='Work out the statistics of only about FRACTION of the elements of each type (and the first one), estimating the per type statistics with 95%% confidence intervals (no --debug or --corpus)')
+    parser.add_argument('--serve', metavar='SOCKET', help='Keep running, reporting on each document sent to this Unix socket instead of on files')
+    parser.add_argument('--queue', type=int, default=SERVE_QUEUE, help='Most submissions left waiting for --serve before new ones are answered BUSY (default: ' + str(SERVE_QUEUE) + ')')
+    parser.add_argument('--profile', metavar='FILE', help='Write per-phase wall and CPU times, cache hit ratios, node counts and peak memory as JSON to FILE (- for stderr)')
+    parser.add_argument('-s','--stream', action='store_true', help='Flag to read each file incrementally, keeping memory bounded by document depth and the number of element types (no --debug output)')
 
+    #runs the program
+    args = parser.parse_args()
+    if args.stream and args.debug:
+        parser.error('--debug needs the full tree and cannot be combined with --stream')
+    if args.sample is not None and not 0 < args.sample <= 1:
+        parser.error('--sample needs a fraction greater than 0 and at most 1')
+    if args.sample is not None and (args.debug or args.corpus):
+        parser.error('--sample estimates cannot be combined with --debug or added to a --corpus')
+    if args.serve and (args.files or args.debug or args.profile or args.coverage or args.corpus or args.output):
+        parser.error('--serve reports on submitted documents and cannot be combined with files, --debug, --profile, --coverage, --corpus or --output')
+    if args.coverage_diff and not args.coverage:
+        parser.error('--coverage-diff needs --coverage')
+    if args.merge and not args.corpus:
+        parser.error('--merge needs --corpus')
+    for path in args.merge or []:
+        if not os.path.isfile(path):
+            parser.error('--merge file ' + path + ' does not exist')
+    if not args.serve and not args.files:
+        parser.error('no files to analyze')
+    if args.serve:
+        try:
+            remove_stale_socket(args.serve)
+        except IOError as e:
+            parser.error(str(e))
+    sys.exit(stix_report.main(args))